@@ -5,6 +5,7 @@ Handles token validation and user context injection.
 
 import os
 from typing import Optional
+from uuid import uuid4
 import jwt
 import structlog
 from fastapi import HTTPException, Request, Response
@@ -43,9 +44,18 @@ class AuthMiddleware(BaseHTTPMiddleware):
         """
         Processes the request, verifies authentication, and injects user context.
         """
+        # Bind correlation fields once; every log line in this request picks them up
+        request_id = request.headers.get("X-Request-ID") or uuid4().hex
+        structlog.contextvars.clear_contextvars()
+        structlog.contextvars.bind_contextvars(
+            request_id=request_id,
+            path=request.url.path,
+            method=request.method,
+        )
+
         # Skip authentication for public routes
         if self._is_public_route(request.url.path):
-            return await call_next(request)
+            return self._with_request_id(await call_next(request), request_id)
 
         # Extract and verify token
         try:
@@ -55,19 +65,27 @@ class AuthMiddleware(BaseHTTPMiddleware):
                 request.state.user = user
                 request.state.user_id = user["sub"]
                 request.state.org_id = user.get("org_id")
+                structlog.contextvars.bind_contextvars(user_id=user["sub"])
             else:
                 raise HTTPException(status_code=401, detail="Invalid or missing authentication token")
         except HTTPException as e:
             logger.warning(
                 "Authentication failed",
-                path=request.url.path,
-                method=request.method,
                 error=e.detail,
                 ip=request.client.host if request.client else "unknown"
             )
-            return Response(content=f'{{"detail":"{e.detail}"}}', status_code=e.status_code, media_type="application/json")
+            return self._with_request_id(
+                Response(content=f'{{"detail":"{e.detail}"}}', status_code=e.status_code, media_type="application/json"),
+                request_id,
+            )
+
+        return self._with_request_id(await call_next(request), request_id)
 
-        return await call_next(request)
+    @staticmethod
+    def _with_request_id(response: Response, request_id: str) -> Response:
+        """Echo the correlation ID so clients can match responses to log lines."""
+        response.headers["X-Request-ID"] = request_id
+        return response
 
     def _is_public_route(self, path: str) -> bool:
         """Check if the route is public."""
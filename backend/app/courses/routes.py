@@ -12,6 +12,7 @@ from fastapi import APIRouter, HTTPException, Request, Depends, Query, Backgroun
 from supabase import create_client, Client
 
 from app.auth.middleware import get_current_user, require_sme, require_manager
+from app.database import invalidate_user_stats
 from app.courses.models import (
     CreateCourseRequest,
     UpdateCourseRequest,
@@ -370,6 +371,8 @@ async def enroll_in_course(
         if not enrollment_response.data:
             raise HTTPException(status_code=500, detail="Failed to create enrollment")
         
+        await invalidate_user_stats(user["sub"])
+        
         enrollment = enrollment_response.data[0]
         
         logger.info(
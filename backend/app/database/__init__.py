@@ -4,7 +4,14 @@ Provides centralized connection management, query optimization, and performance
 """
 
 from .connection import DatabaseManager, get_db_manager, init_database, cleanup_database
-from .cache import QueryCache, get_query_cache, init_cache, cleanup_cache
+from .cache import (
+    QueryCache,
+    get_query_cache,
+    init_cache,
+    cleanup_cache,
+    user_stats_tag,
+    invalidate_user_stats,
+)
 from .monitoring import DatabaseMetrics, get_db_metrics, init_monitoring, cleanup_monitoring
 from .optimization import QueryOptimizer, BatchProcessor
 
@@ -17,6 +24,8 @@ __all__ = [
     "get_query_cache",
     "init_cache",
     "cleanup_cache",
+    "user_stats_tag",
+    "invalidate_user_stats",
     "DatabaseMetrics",
     "get_db_metrics",
     "init_monitoring",
@@ -296,6 +296,17 @@ def cache_query(ttl: int = 300, tags: Optional[Set[str]] = None):
 _query_cache: Optional[QueryCache] = None
 
 
+def user_stats_tag(user_id: str) -> str:
+    """Cache tag for a user's aggregated statistics."""
+    return f"user_stats:{user_id}"
+
+
+async def invalidate_user_stats(user_id: str):
+    """Drop cached statistics for a user after an XP, badge, enrollment or forum write."""
+    cache = await get_query_cache()
+    await cache.invalidate_by_tags({user_stats_tag(user_id)})
+
+
 async def get_query_cache() -> QueryCache:
     """Get the global query cache instance."""
     global _query_cache
@@ -113,6 +113,10 @@ class DatabaseManager:
                     max_queries=50000,
                     max_inactive_connection_lifetime=300.0,
                     command_timeout=60.0,
+                    # Prepared statements are cached per connection, so repeated
+                    # queries (stats, profile lookups) skip parse/plan; set to 0
+                    # behind a transaction-mode pooler
+                    statement_cache_size=int(os.getenv("PG_STATEMENT_CACHE_SIZE", "1024")),
                     ssl=True,
                     server_settings={
                         'application_name': 'k-orbit-backend',
@@ -139,6 +143,11 @@ class DatabaseManager:
             raise RuntimeError("DatabaseManager not initialized. Call initialize() first.")
         return self._supabase_admin_client
     
+    @property
+    def has_pg_pool(self) -> bool:
+        """Whether direct PostgreSQL access is available."""
+        return self._pg_pool is not None
+    
     @asynccontextmanager
     async def get_pg_connection(self):
         """Get a PostgreSQL connection from the pool."""
@@ -12,6 +12,7 @@ from fastapi import APIRouter, HTTPException, Request, Depends, Query, Backgroun
 from supabase import create_client, Client
 
 from app.auth.middleware import get_current_user, require_sme, require_manager
+from app.database import invalidate_user_stats
 from app.forum.models import (
     CreateQuestionRequest,
     UpdateQuestionRequest,
@@ -323,6 +324,8 @@ async def create_answer(
         if not answer_response.data:
             raise HTTPException(status_code=500, detail="Failed to create answer")
         
+        await invalidate_user_stats(user["sub"])
+        
         answer = answer_response.data[0]
         
         # Award XP for answering
@@ -590,6 +593,7 @@ async def _award_forum_xp(user_id: str, source: str, source_id: str):
                 "created_at": datetime.utcnow().isoformat()
             }
             supabase.table("xp_transactions").insert(xp_data).execute()
+            await invalidate_user_stats(user_id)
             
             logger.info(
                 "Forum XP awarded",
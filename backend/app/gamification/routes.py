@@ -11,6 +11,7 @@ from fastapi import APIRouter, HTTPException, Request, Depends, Query, Backgroun
 from supabase import create_client, Client
 
 from app.auth.middleware import get_current_user, require_admin, require_manager
+from app.database import invalidate_user_stats
 from app.gamification.models import (
     XPTransactionRequest,
     XPTransactionResponse,
@@ -46,16 +47,15 @@ async def get_user_gamification_profile(
     Get current user's gamification profile with XP, level, and badges.
     """
     try:
-        # Get user's total XP
-        xp_response = supabase.table("xp_transactions").select("xp_earned").eq("user_id", user["sub"]).execute()
-        total_xp = sum(xp["xp_earned"] for xp in xp_response.data) if xp_response.data else 0
+        # Get user's total XP and badge count (summed and counted in the database)
+        stats_response = supabase.rpc("get_user_stats", {"p_user": user["sub"]}).execute()
+        stats = stats_response.data[0] if stats_response.data else {}
+        total_xp = stats.get("total_xp") or 0
         
         # Calculate level and progress
         level, level_progress, xp_to_next = _calculate_level_info(total_xp)
         
-        # Get badges count
-        badges_response = supabase.table("user_badges").select("id").eq("user_id", user["sub"]).execute()
-        badges_earned = len(badges_response.data) if badges_response.data else 0
+        badges_earned = stats.get("badges_earned") or 0
         
         # Get user rank in organization
         rank = await _get_user_rank(user["sub"], user["org_id"])
@@ -147,6 +147,8 @@ async def award_xp(
         if not xp_response.data:
             raise HTTPException(status_code=500, detail="Failed to award XP")
         
+        await invalidate_user_stats(request.user_id)
+        
         xp_transaction = xp_response.data[0]
         
         # Check for new badges in background
@@ -426,6 +428,8 @@ async def award_badge(
             }
             supabase.table("xp_transactions").insert(xp_data).execute()
         
+        await invalidate_user_stats(request.user_id)
+        
         logger.info(
             "Badge awarded",
             user_id=request.user_id,
@@ -595,6 +599,7 @@ async def _check_badge_criteria(user_id: str):
                     "earned_at": datetime.utcnow().isoformat()
                 }
                 supabase.table("user_badges").insert(user_badge_data).execute()
+                await invalidate_user_stats(user_id)
                 
                 logger.info(
                     "Badge automatically awarded",
@@ -3,16 +3,21 @@ K-Orbit Backend API
 FastAPI application with Supabase integration, WebSocket support, and AI capabilities.
 """
 
+import asyncio
 import logging
+import logging.handlers
 import os
+import queue
+import sys
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
+import orjson
 import structlog
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from dotenv import load_dotenv
 
 from app.auth.middleware import AuthMiddleware
@@ -21,7 +26,8 @@ from app.users.routes import router as users_router
 from app.courses.routes import router as courses_router
 from app.gamification.routes import router as gamification_router
 from app.ai_agent.routes import router as ai_agent_router
-from app.resources.routes import router as resources_router
+from app.resources.middleware import UploadSizeLimitMiddleware
+from app.resources.routes import MAX_FILE_SIZE, router as resources_router
 from app.forum.routes import router as forum_router
 from app.analytics.routes import router as analytics_router
 from app.realtime.websocket import websocket_router
@@ -30,32 +36,62 @@ from app.database.supabase_client import supabase
 # Load environment variables
 load_dotenv()
 
-# Configure structured logging
+# Configure structured logging. Loggers filter by level at bind time; records
+# are rendered to JSON by ProcessorFormatter and handed to a QueueHandler, so
+# the stdout write happens on the QueueListener thread, never on the event loop.
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+
+_shared_log_processors = [
+    structlog.contextvars.merge_contextvars,
+    structlog.stdlib.add_logger_name,
+    structlog.processors.add_log_level,
+    structlog.processors.TimeStamper(fmt="iso", utc=True),
+]
+
 structlog.configure(
     processors=[
-        structlog.stdlib.filter_by_level,
-        structlog.stdlib.add_logger_name,
-        structlog.stdlib.add_log_level,
-        structlog.stdlib.PositionalArgumentsFormatter(),
-        structlog.processors.TimeStamper(fmt="iso"),
+        *_shared_log_processors,
         structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
-        structlog.processors.UnicodeDecoder(),
-        structlog.processors.JSONRenderer()
+        structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
     ],
-    context_class=dict,
+    wrapper_class=structlog.make_filtering_bound_logger(LOG_LEVEL),
     logger_factory=structlog.stdlib.LoggerFactory(),
-    wrapper_class=structlog.stdlib.BoundLogger,
     cache_logger_on_first_use=True,
 )
 
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(
+    structlog.stdlib.ProcessorFormatter(
+        foreign_pre_chain=_shared_log_processors,
+        processors=[
+            structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            structlog.processors.format_exc_info,
+            structlog.processors.JSONRenderer(
+                serializer=lambda obj, **kw: orjson.dumps(obj, default=str).decode()
+            ),
+        ],
+    )
+)
+_root_logger = logging.getLogger()
+_root_logger.handlers = [_queue_handler]
+_root_logger.setLevel(LOG_LEVEL)
+
+log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(sys.stdout), respect_handler_level=True
+)
+
 logger = structlog.get_logger()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Application lifespan management."""
-    logger.info("K-Orbit API starting up...")
+    log_listener.start()
+    logger.info(
+        "K-Orbit API starting up...",
+        event_loop=type(asyncio.get_running_loop()).__module__
+    )
     
     # Initialize services
     try:
@@ -78,6 +114,7 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         await cleanup_monitoring()
         
         logger.info("K-Orbit API shutting down...")
+        log_listener.stop()
 
 
 # Create FastAPI application
@@ -87,6 +124,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs" if os.getenv("ENVIRONMENT") != "production" else None,
     redoc_url="/redoc" if os.getenv("ENVIRONMENT") != "production" else None,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -97,6 +135,14 @@ if os.getenv("ENVIRONMENT") == "production":
         allowed_hosts=os.getenv("ALLOWED_HOSTS", "").split(",")
     )
 
+# Reject oversized uploads before FastAPI reads the multipart body
+# (added before CORS so the 413 still carries CORS headers)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    path="/api/resources/upload",
+    max_bytes=MAX_FILE_SIZE
+)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -197,5 +243,6 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=int(os.getenv("PORT", "8000")),
         reload=os.getenv("ENVIRONMENT") != "production",
+        loop="auto",  # uvloop when installed, asyncio otherwise
         log_config=None  # Use structlog instead
     )
\ No newline at end of file
@@ -23,6 +23,7 @@ class EventType(Enum):
     # AI Chat Events
     AI_TYPING_START = "ai_typing_start"
     AI_TYPING_STOP = "ai_typing_stop"
+    AI_STREAM_START = "ai_stream_start"
     AI_RESPONSE_STREAM = "ai_response_stream"
     AI_RESPONSE_COMPLETE = "ai_response_complete"
     
@@ -128,8 +129,8 @@ class RealTimeFeatures:
     
     async def stop_ai_typing_indicator(self, conversation_id: str):
         """Stop AI typing indicator."""
-        if conversation_id in self.active_ai_sessions:
-            session = self.active_ai_sessions[conversation_id]
+        session = self.active_ai_sessions.get(conversation_id)
+        if session and session["typing"]:
             
             event = RealTimeEvent(
                 event_type=EventType.AI_TYPING_STOP,
@@ -146,6 +147,30 @@ class RealTimeFeatures:
             # Update session
             session["typing"] = False
     
+    async def stream_ai_response_first(self, conversation_id: str, chunk: str):
+        """Send the first AI response chunk, which also clears the typing indicator."""
+        session = self.active_ai_sessions.get(conversation_id)
+        if not session:
+            return
+        
+        event = RealTimeEvent(
+            event_type=EventType.AI_STREAM_START,
+            user_id=session["user_id"],
+            target_users=[session["user_id"]],
+            room=f"conversation:{conversation_id}",
+            payload={
+                "conversation_id": conversation_id,
+                "chunk": chunk,
+                "is_complete": False,
+                "typing_stopped": True,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+        )
+        
+        await self._send_event(event)
+        
+        session["typing"] = False
+    
     async def stream_ai_response(self, conversation_id: str, chunk: str, is_complete: bool = False):
         """Stream AI response in real-time chunks."""
         if conversation_id not in self.active_ai_sessions:
@@ -559,7 +584,7 @@ class RealTimeFeatures:
             if event.target_users:
                 # Send to specific users
                 for user_id in event.target_users:
-                    await self.connection_manager.send_personal_message(message, user_id)
+                    await self.connection_manager.send_message_to_user(message, user_id)
             elif event.room:
                 # Send to room
                 await self.connection_manager.broadcast_to_room(message, event.room)
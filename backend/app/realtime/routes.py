@@ -3,8 +3,10 @@ API routes for real-time features management and testing.
 Provides endpoints for triggering real-time events and managing live features.
 """
 
-from typing import Dict, Any, List
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+import asyncio
+from typing import Dict, Any, List, Optional, Set
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 import structlog
 
@@ -22,6 +24,9 @@ logger = structlog.get_logger()
 
 router = APIRouter()
 
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+_background_tasks: Set[asyncio.Task] = set()
+
 
 # ===============================================
 # REQUEST MODELS
@@ -29,7 +34,7 @@ router = APIRouter()
 
 class SendAnnouncementRequest(BaseModel):
     message: str
-    target_role: str = None
+    target_role: Optional[str] = None
     priority: str = "normal"
 
 
@@ -54,7 +59,7 @@ class HelpResponseModel(BaseModel):
 class ProgressUpdateRequest(BaseModel):
     lesson_id: str
     progress: float
-    checkpoint: str = None
+    checkpoint: Optional[str] = None
 
 
 class TestStreamingRequest(BaseModel):
@@ -70,30 +75,25 @@ class TestStreamingRequest(BaseModel):
 @router.get("/stats")
 async def get_realtime_stats(user: dict = Depends(get_current_user)) -> Dict[str, Any]:
     """Get real-time system statistics."""
-    try:
-        # Check if user has admin privileges
-        if user.get("role") not in ["admin", "super_admin"]:
-            raise HTTPException(status_code=403, detail="Admin privileges required")
-        
-        realtime_features = get_realtime_features(manager)
-        connection_stats = {
-            "total_connections": sum(len(conns) for conns in manager.active_connections.values()),
-            "active_users": len(manager.active_connections),
-            "room_subscriptions": len(manager.room_subscriptions)
+    # Check if user has admin privileges
+    if user.get("role") not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    realtime_features = get_realtime_features(manager)
+    connection_stats = {
+        "total_connections": sum(len(conns) for conns in manager.active_connections.values()),
+        "active_users": len(manager.active_connections),
+        "room_subscriptions": len(manager.room_subscriptions)
+    }
+    
+    return {
+        "connection_stats": connection_stats,
+        "realtime_features_stats": realtime_features.get_statistics(),
+        "websocket_manager_stats": {
+            "rooms": list(manager.room_subscriptions.keys())[:10],  # First 10 rooms
+            "total_rooms": len(manager.room_subscriptions)
         }
-        
-        return {
-            "connection_stats": connection_stats,
-            "realtime_features_stats": realtime_features.get_statistics(),
-            "websocket_manager_stats": {
-                "rooms": list(manager.room_subscriptions.keys())[:10],  # First 10 rooms
-                "total_rooms": len(manager.room_subscriptions)
-            }
-        }
-        
-    except Exception as e:
-        logger.error("Failed to get real-time stats", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to retrieve statistics")
+    }
 
 
 @router.post("/announcement")
@@ -102,29 +102,24 @@ async def send_announcement(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Send system-wide announcement."""
-    try:
-        # Check permissions
-        if user.get("role") not in ["admin", "super_admin"]:
-            raise HTTPException(status_code=403, detail="Admin privileges required")
-        
-        realtime_features = get_realtime_features(manager)
-        
-        await realtime_features.send_system_announcement(
-            message=request.message,
-            target_role=request.target_role,
-            org_id=user.get("org_id"),
-            priority=request.priority
-        )
-        
-        logger.info("System announcement sent",
-                   user_id=user["sub"],
-                   message=request.message[:100])
-        
-        return {"message": "Announcement sent successfully"}
-        
-    except Exception as e:
-        logger.error("Failed to send announcement", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to send announcement")
+    # Check permissions
+    if user.get("role") not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    realtime_features = get_realtime_features(manager)
+    
+    await realtime_features.send_system_announcement(
+        message=request.message,
+        target_role=request.target_role,
+        org_id=user.get("org_id"),
+        priority=request.priority
+    )
+    
+    logger.info("System announcement sent",
+               user_id=user["sub"],
+               message=request.message[:100])
+    
+    return {"message": "Announcement sent successfully"}
 
 
 # ===============================================
@@ -134,41 +129,43 @@ async def send_announcement(
 @router.post("/ai/test-streaming")
 async def test_ai_streaming(
     request: TestStreamingRequest,
-    background_tasks: BackgroundTasks,
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Test AI response streaming."""
-    try:
-        streaming_manager = get_streaming_manager(manager)
-        
-        if request.use_streaming:
-            # Start streaming in background
-            background_tasks.add_task(
-                _stream_test_response,
-                streaming_manager,
-                request.conversation_id,
-                user["sub"],
-                request.message
-            )
-            return {"message": "Streaming started", "conversation_id": request.conversation_id}
-        else:
-            # Send immediate response
-            realtime_features = get_realtime_features(manager)
-            await realtime_features.stream_ai_response(
-                request.conversation_id,
-                f"Test response to: {request.message}",
-                True
-            )
-            return {"message": "Response sent", "conversation_id": request.conversation_id}
-        
-    except Exception as e:
-        logger.error("AI streaming test failed", error=str(e))
-        raise HTTPException(status_code=500, detail="Streaming test failed")
+    streaming_manager = get_streaming_manager(manager)
+    
+    if request.use_streaming:
+        # Start streaming immediately rather than after the response is sent
+        task = asyncio.create_task(_stream_test_response(
+            streaming_manager,
+            request.conversation_id,
+            user["sub"],
+            request.message
+        ))
+        _background_tasks.add(task)
+        task.add_done_callback(_on_stream_task_done)
+        return {"message": "Streaming started", "conversation_id": request.conversation_id}
+    else:
+        # Send immediate response
+        realtime_features = get_realtime_features(manager)
+        await realtime_features.stream_ai_response(
+            request.conversation_id,
+            f"Test response to: {request.message}",
+            True
+        )
+        return {"message": "Response sent", "conversation_id": request.conversation_id}
+
+
+def _on_stream_task_done(task: asyncio.Task):
+    """Release the task reference and surface any unhandled failure."""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Streaming task failed", error=str(task.exception()))
 
 
 async def _stream_test_response(streaming_manager, conversation_id: str, 
                               user_id: str, message: str):
-    """Background task for streaming test response."""
+    """Task for streaming test response."""
     try:
         context = "You are a helpful AI assistant for K-Orbit learning platform. "
         
@@ -184,45 +181,35 @@ async def _stream_test_response(streaming_manager, conversation_id: str,
 
 @router.post("/ai/typing/start")
 async def start_typing_indicator(
-    conversation_id: str,
+    conversation_id: UUID = Query(...),
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Start typing indicator for user."""
-    try:
-        typing_indicator = get_typing_indicator(manager)
-        
-        await typing_indicator.start_user_typing(
-            conversation_id=conversation_id,
-            user_id=user["sub"],
-            user_name=user.get("full_name", "User")
-        )
-        
-        return {"message": "Typing indicator started"}
-        
-    except Exception as e:
-        logger.error("Failed to start typing indicator", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to start typing indicator")
+    typing_indicator = get_typing_indicator(manager)
+    
+    await typing_indicator.start_user_typing(
+        conversation_id=conversation_id,
+        user_id=user["sub"],
+        user_name=user.get("full_name", "User")
+    )
+    
+    return {"message": "Typing indicator started"}
 
 
 @router.post("/ai/typing/stop")
 async def stop_typing_indicator(
-    conversation_id: str,
+    conversation_id: UUID = Query(...),
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Stop typing indicator for user."""
-    try:
-        typing_indicator = get_typing_indicator(manager)
-        
-        await typing_indicator.stop_user_typing(
-            conversation_id=conversation_id,
-            user_id=user["sub"]
-        )
-        
-        return {"message": "Typing indicator stopped"}
-        
-    except Exception as e:
-        logger.error("Failed to stop typing indicator", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to stop typing indicator")
+    typing_indicator = get_typing_indicator(manager)
+    
+    await typing_indicator.stop_user_typing(
+        conversation_id=conversation_id,
+        user_id=user["sub"]
+    )
+    
+    return {"message": "Typing indicator stopped"}
 
 
 # ===============================================
@@ -236,25 +223,20 @@ async def start_lesson_tracking(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Start tracking lesson progress."""
-    try:
-        progress_tracker = get_progress_tracker(manager)
-        
-        lesson_data = {
-            "id": lesson_id,
-            "title": lesson_title
-        }
-        
-        await progress_tracker.start_lesson_session(
-            user_id=user["sub"],
-            lesson_id=lesson_id,
-            lesson_data=lesson_data
-        )
-        
-        return {"message": "Lesson tracking started", "lesson_id": lesson_id}
-        
-    except Exception as e:
-        logger.error("Failed to start lesson tracking", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to start lesson tracking")
+    progress_tracker = get_progress_tracker(manager)
+    
+    lesson_data = {
+        "id": lesson_id,
+        "title": lesson_title
+    }
+    
+    await progress_tracker.start_lesson_session(
+        user_id=user["sub"],
+        lesson_id=lesson_id,
+        lesson_data=lesson_data
+    )
+    
+    return {"message": "Lesson tracking started", "lesson_id": lesson_id}
 
 
 @router.post("/progress/lesson/update")
@@ -263,21 +245,16 @@ async def update_lesson_progress(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Update lesson progress."""
-    try:
-        progress_tracker = get_progress_tracker(manager)
-        
-        await progress_tracker.update_lesson_progress(
-            user_id=user["sub"],
-            lesson_id=request.lesson_id,
-            progress=request.progress,
-            checkpoint=request.checkpoint
-        )
-        
-        return {"message": "Progress updated", "progress": request.progress}
-        
-    except Exception as e:
-        logger.error("Failed to update progress", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to update progress")
+    progress_tracker = get_progress_tracker(manager)
+    
+    await progress_tracker.update_lesson_progress(
+        user_id=user["sub"],
+        lesson_id=request.lesson_id,
+        progress=request.progress,
+        checkpoint=request.checkpoint
+    )
+    
+    return {"message": "Progress updated", "progress": request.progress}
 
 
 @router.post("/progress/lesson/complete")
@@ -287,20 +264,15 @@ async def complete_lesson(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Complete lesson and send notifications."""
-    try:
-        progress_tracker = get_progress_tracker(manager)
-        
-        await progress_tracker.complete_lesson_session(
-            user_id=user["sub"],
-            lesson_id=lesson_id,
-            final_score=final_score
-        )
-        
-        return {"message": "Lesson completed", "lesson_id": lesson_id}
-        
-    except Exception as e:
-        logger.error("Failed to complete lesson", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to complete lesson")
+    progress_tracker = get_progress_tracker(manager)
+    
+    await progress_tracker.complete_lesson_session(
+        user_id=user["sub"],
+        lesson_id=lesson_id,
+        final_score=final_score
+    )
+    
+    return {"message": "Lesson completed", "lesson_id": lesson_id}
 
 
 # ===============================================
@@ -315,26 +287,21 @@ async def award_xp(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Award XP to user (admin only)."""
-    try:
-        # Check permissions
-        if user.get("role") not in ["admin", "super_admin"]:
-            raise HTTPException(status_code=403, detail="Admin privileges required")
-        
-        realtime_features = get_realtime_features(manager)
-        
-        recipient_id = target_user_id or user["sub"]
-        
-        await realtime_features.notify_xp_earned(
-            user_id=recipient_id,
-            xp_amount=amount,
-            source=source
-        )
-        
-        return {"message": f"Awarded {amount} XP", "recipient": recipient_id}
-        
-    except Exception as e:
-        logger.error("Failed to award XP", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to award XP")
+    # Check permissions
+    if user.get("role") not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    realtime_features = get_realtime_features(manager)
+    
+    recipient_id = target_user_id or user["sub"]
+    
+    await realtime_features.notify_xp_earned(
+        user_id=recipient_id,
+        xp_amount=amount,
+        source=source
+    )
+    
+    return {"message": f"Awarded {amount} XP", "recipient": recipient_id}
 
 
 @router.post("/gamification/badge/unlock")
@@ -345,32 +312,27 @@ async def unlock_badge(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Unlock badge for user (admin only)."""
-    try:
-        # Check permissions
-        if user.get("role") not in ["admin", "super_admin"]:
-            raise HTTPException(status_code=403, detail="Admin privileges required")
-        
-        realtime_features = get_realtime_features(manager)
-        
-        recipient_id = target_user_id or user["sub"]
-        
-        badge_data = {
-            "name": badge_name,
-            "description": badge_description,
-            "icon_url": "/badges/default.png",
-            "rarity": "common"
-        }
-        
-        await realtime_features.notify_badge_unlocked(
-            user_id=recipient_id,
-            badge_data=badge_data
-        )
-        
-        return {"message": f"Badge '{badge_name}' unlocked", "recipient": recipient_id}
-        
-    except Exception as e:
-        logger.error("Failed to unlock badge", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to unlock badge")
+    # Check permissions
+    if user.get("role") not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    realtime_features = get_realtime_features(manager)
+    
+    recipient_id = target_user_id or user["sub"]
+    
+    badge_data = {
+        "name": badge_name,
+        "description": badge_description,
+        "icon_url": "/badges/default.png",
+        "rarity": "common"
+    }
+    
+    await realtime_features.notify_badge_unlocked(
+        user_id=recipient_id,
+        badge_data=badge_data
+    )
+    
+    return {"message": f"Badge '{badge_name}' unlocked", "recipient": recipient_id}
 
 
 # ===============================================
@@ -383,21 +345,16 @@ async def create_study_session(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Create a new study session."""
-    try:
-        collaboration_manager = get_collaboration_manager(manager)
-        
-        session_id = await collaboration_manager.create_study_session(
-            creator_id=user["sub"],
-            course_id=request.course_id,
-            topic=request.topic,
-            max_participants=request.max_participants
-        )
-        
-        return {"message": "Study session created", "session_id": session_id}
-        
-    except Exception as e:
-        logger.error("Failed to create study session", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to create study session")
+    collaboration_manager = get_collaboration_manager(manager)
+    
+    session_id = await collaboration_manager.create_study_session(
+        creator_id=user["sub"],
+        course_id=request.course_id,
+        topic=request.topic,
+        max_participants=request.max_participants
+    )
+    
+    return {"message": "Study session created", "session_id": session_id}
 
 
 @router.post("/collaboration/study-session/{session_id}/join")
@@ -406,23 +363,18 @@ async def join_study_session(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Join an existing study session."""
-    try:
-        collaboration_manager = get_collaboration_manager(manager)
-        
-        success = await collaboration_manager.join_study_session(
-            session_id=session_id,
-            user_id=user["sub"],
-            user_name=user.get("full_name", "User")
-        )
-        
-        if success:
-            return {"message": "Joined study session", "session_id": session_id}
-        else:
-            raise HTTPException(status_code=400, detail="Unable to join session")
-        
-    except Exception as e:
-        logger.error("Failed to join study session", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to join study session")
+    collaboration_manager = get_collaboration_manager(manager)
+    
+    success = await collaboration_manager.join_study_session(
+        session_id=session_id,
+        user_id=user["sub"],
+        user_name=user.get("full_name", "User")
+    )
+    
+    if success:
+        return {"message": "Joined study session", "session_id": session_id}
+    else:
+        raise HTTPException(status_code=400, detail="Unable to join session")
 
 
 @router.post("/collaboration/help/request")
@@ -431,22 +383,17 @@ async def request_peer_help(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Request help from peers."""
-    try:
-        collaboration_manager = get_collaboration_manager(manager)
-        
-        request_id = await collaboration_manager.request_peer_help(
-            user_id=user["sub"],
-            course_id=request.course_id,
-            lesson_id=request.lesson_id,
-            question=request.question,
-            urgency=request.urgency
-        )
-        
-        return {"message": "Help request sent", "request_id": request_id}
-        
-    except Exception as e:
-        logger.error("Failed to request help", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to request help")
+    collaboration_manager = get_collaboration_manager(manager)
+    
+    request_id = await collaboration_manager.request_peer_help(
+        user_id=user["sub"],
+        course_id=request.course_id,
+        lesson_id=request.lesson_id,
+        question=request.question,
+        urgency=request.urgency
+    )
+    
+    return {"message": "Help request sent", "request_id": request_id}
 
 
 @router.post("/collaboration/help/respond")
@@ -455,21 +402,16 @@ async def respond_to_help_request(
     user: dict = Depends(get_current_user)
 ) -> Dict[str, str]:
     """Respond to a peer help request."""
-    try:
-        collaboration_manager = get_collaboration_manager(manager)
-        
-        await collaboration_manager.respond_to_help_request(
-            request_id=request.request_id,
-            helper_id=user["sub"],
-            helper_name=user.get("full_name", "User"),
-            response=request.response
-        )
-        
-        return {"message": "Help response sent"}
-        
-    except Exception as e:
-        logger.error("Failed to respond to help request", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to respond to help request")
+    collaboration_manager = get_collaboration_manager(manager)
+    
+    await collaboration_manager.respond_to_help_request(
+        request_id=request.request_id,
+        helper_id=user["sub"],
+        helper_name=user.get("full_name", "User"),
+        response=request.response
+    )
+    
+    return {"message": "Help response sent"}
 
 
 # ===============================================
@@ -479,36 +421,26 @@ async def respond_to_help_request(
 @router.post("/presence/online")
 async def set_user_online(user: dict = Depends(get_current_user)) -> Dict[str, str]:
     """Set user as online."""
-    try:
-        realtime_features = get_realtime_features(manager)
-        
-        await realtime_features.notify_user_online(
-            user_id=user["sub"],
-            user_info={
-                "full_name": user.get("full_name"),
-                "avatar_url": user.get("avatar_url"),
-                "org_id": user.get("org_id"),
-                "role": user.get("role")
-            }
-        )
-        
-        return {"message": "User set as online"}
-        
-    except Exception as e:
-        logger.error("Failed to set user online", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to set user online")
+    realtime_features = get_realtime_features(manager)
+    
+    await realtime_features.notify_user_online(
+        user_id=user["sub"],
+        user_info={
+            "full_name": user.get("full_name"),
+            "avatar_url": user.get("avatar_url"),
+            "org_id": user.get("org_id"),
+            "role": user.get("role")
+        }
+    )
+    
+    return {"message": "User set as online"}
 
 
 @router.post("/presence/offline")
 async def set_user_offline(user: dict = Depends(get_current_user)) -> Dict[str, str]:
     """Set user as offline."""
-    try:
-        realtime_features = get_realtime_features(manager)
-        
-        await realtime_features.notify_user_offline(user_id=user["sub"])
-        
-        return {"message": "User set as offline"}
-        
-    except Exception as e:
-        logger.error("Failed to set user offline", error=str(e))
-        raise HTTPException(status_code=500, detail="Failed to set user offline") 
\ No newline at end of file
+    realtime_features = get_realtime_features(manager)
+    
+    await realtime_features.notify_user_offline(user_id=user["sub"])
+    
+    return {"message": "User set as offline"}
@@ -1,20 +1,246 @@
 """
 AI Response Streaming System for K-Orbit.
 Provides real-time streaming of AI responses with typing indicators and chunk delivery.
+
+The managers here lean on the event loop for every chunk and broadcast, so
+production runs uvicorn with ``--loop uvloop``.
 """
 
 import asyncio
+import hashlib
+import itertools
 import json
+import os
+import threading
 import time
-from typing import AsyncGenerator, Dict, Any, Optional
+from dataclasses import dataclass, field, asdict
+from functools import lru_cache
+from typing import AsyncGenerator, Dict, Any, List, Optional, Tuple
+from uuid import UUID
 import structlog
 import google.generativeai as genai
-from datetime import datetime
+from google.generativeai import caching
+from datetime import datetime, timedelta
 
 from app.realtime.features import RealTimeFeatures, get_realtime_features
+from app.realtime.websocket import _encode
 
 logger = structlog.get_logger()
 
+_utcnow = datetime.utcnow
+
+# Gemini explicit context caching: sha256(context) -> (CachedContent, expires_at).
+# A None entry records a failed create, so the context is sent inline until it
+# expires. Accessed from asyncio.to_thread workers, so every read/write holds the lock.
+_context_cache: Dict[str, Tuple[Optional[caching.CachedContent], float]] = {}
+_context_cache_lock = threading.Lock()
+# One model for cached and inline contexts, so responses don't change with
+# context length. Explicit caching needs a versioned model that supports it.
+STREAMING_MODEL = os.getenv("AI_STREAMING_MODEL", "models/gemini-1.5-flash-001")
+CONTEXT_CACHE_TTL = timedelta(minutes=5)
+CONTEXT_CACHE_MIN_TOKENS = 2048  # Provider minimum for explicit caching
+CONTEXT_CACHE_FAILURE_TTL = 60  # Seconds before retrying a failed create
+
+# Process-wide id sequence; second-resolution timestamps collide under load
+_id_counter = itertools.count(1)
+
+# Chunk endings that trigger an immediate flush to subscribers
+_FLUSH_CHARS = frozenset(' .!?\n')
+
+
+def _get_cached_context(context: str) -> Optional[caching.CachedContent]:
+    """
+    Get the Gemini cached content for a context, creating it if needed.
+    The object (not its name) is returned so building a model from it
+    doesn't cost another CachedContent.get round-trip.
+    
+    Returns None for contexts below the provider minimum or if caching fails,
+    in which case the caller should send the context inline.
+    """
+    # Rough estimate of ~4 characters per token
+    if len(context) // 4 < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    
+    key = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    now = time.time()
+    
+    with _context_cache_lock:
+        entry = _context_cache.get(key)
+        if entry:
+            cached_content, expires_at = entry
+            if expires_at > now:
+                return cached_content
+            _context_cache.pop(key, None)
+    
+    # Created outside the lock; two threads racing on the same context at
+    # worst both create it and the later one wins the slot
+    try:
+        cached_content = caching.CachedContent.create(
+            model=STREAMING_MODEL,
+            system_instruction=None,
+            contents=[context],
+            ttl=CONTEXT_CACHE_TTL
+        )
+    except Exception as e:
+        logger.warning("Gemini context caching failed", error=str(e))
+        cached_content = None
+    
+    with _context_cache_lock:
+        # Drop other expired entries while we're here
+        for stale_key in [k for k, (_, exp) in _context_cache.items() if exp <= now]:
+            _context_cache.pop(stale_key, None)
+        
+        if cached_content is None:
+            _context_cache[key] = (None, now + CONTEXT_CACHE_FAILURE_TTL)
+        else:
+            # Expire locally slightly before the server does
+            _context_cache[key] = (cached_content, now + CONTEXT_CACHE_TTL.total_seconds() - 30)
+    return cached_content
+
+
+def _prune_registry(registry: Dict[str, Any], max_entries: int, max_age: float,
+                    now: float) -> None:
+    """
+    Evict entries older than max_age seconds and trim the registry to
+    max_entries. Relies on dict insertion order matching creation order,
+    so callers must re-insert (pop, then set) when replacing a key.
+    """
+    while registry:
+        key = next(iter(registry))
+        entry = registry[key]
+        created = getattr(entry, "created_at", None) or entry.started_at
+        if len(registry) <= max_entries and now - created <= max_age:
+            break
+        del registry[key]
+
+
+class RoomBroadcaster:
+    """
+    Queues room broadcasts and sends them from a small pool of workers, so
+    callers never wait on fan-out. Rooms are pinned to one worker each to
+    keep per-room ordering, and workers yield to the loop between batches.
+    """
+    
+    def __init__(self, connection_manager, workers: int = 4,
+                 max_queued: int = 10000, batch_size: int = 50):
+        self.connection_manager = connection_manager
+        self.batch_size = batch_size
+        self._queues: List[asyncio.Queue] = [
+            asyncio.Queue(maxsize=max_queued // workers) for _ in range(workers)
+        ]
+        self._workers: List[asyncio.Task] = []
+    
+    def broadcast(self, message: Dict[str, Any], room: str):
+        """Encode a message and queue it for delivery to a room."""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._run(q)) for q in self._queues]
+        
+        queue = self._queues[hash(room) % len(self._queues)]
+        try:
+            queue.put_nowait((room, _encode(message)))
+        except asyncio.QueueFull:
+            logger.warning("Broadcast queue full, dropping message",
+                           room=room, type=message.get("type"))
+    
+    async def _run(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            
+            for room, payload in batch:
+                try:
+                    await self.connection_manager.broadcast_to_room(payload, room)
+                except Exception as e:
+                    logger.error("Room broadcast failed", room=room, error=str(e))
+            
+            await asyncio.sleep(0)
+
+
+@lru_cache(maxsize=None)
+def get_room_broadcaster(connection_manager) -> RoomBroadcaster:
+    """Get the room broadcaster for a connection manager."""
+    return RoomBroadcaster(connection_manager)
+
+
+@dataclass(slots=True)
+class StreamSession:
+    """Active AI response stream."""
+    conversation_id: str
+    user_id: str
+    started_at: float
+
+
+@dataclass(slots=True)
+class TypingSession:
+    """User typing indicator session."""
+    conversation_id: UUID
+    user_id: str
+    user_name: str
+    started_at: float
+
+
+@dataclass(slots=True)
+class ProgressSession:
+    """Live lesson progress session."""
+    user_id: str
+    lesson_id: str
+    lesson_data: Dict[str, Any]
+    started_at: float
+    progress: float = 0.0
+    checkpoints: List[Dict[str, Any]] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class StudySession:
+    """Collaborative study session."""
+    id: str
+    creator_id: str
+    course_id: str
+    topic: str
+    max_participants: int
+    participants: List[str]
+    created_at: float
+    status: str = "open"
+
+
+@dataclass(slots=True)
+class HelpRequest:
+    """Peer help request and its responses."""
+    id: str
+    user_id: str
+    course_id: str
+    lesson_id: str
+    question: str
+    urgency: str
+    created_at: float
+    responses: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def _stream_in_thread(model, prompt: str, generation_config, chunk_queue: asyncio.Queue,
+                      loop: asyncio.AbstractEventLoop, stop: threading.Event):
+    """
+    Run a blocking Gemini stream in a worker thread, handing each chunk to the
+    event loop through chunk_queue. Always finishes with a None sentinel.
+    """
+    try:
+        response = model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            stream=True
+        )
+        for chunk in response:
+            if stop.is_set():
+                break
+            if chunk.text:
+                # Blocks while the queue is full, giving natural backpressure
+                asyncio.run_coroutine_threadsafe(chunk_queue.put(chunk.text), loop).result()
+    finally:
+        asyncio.run_coroutine_threadsafe(chunk_queue.put(None), loop).result()
+
 
 class AIStreamingManager:
     """
@@ -23,7 +249,13 @@ class AIStreamingManager:
     
     def __init__(self, realtime_features: RealTimeFeatures):
         self.realtime_features = realtime_features
-        self.active_streams: Dict[str, Dict] = {}
+        self.active_streams: Dict[str, StreamSession] = {}
+        # Cap outbound chunk rate at 50 chunks/s without adding fixed delays
+        self._min_chunk_interval = 1.0 / 50
+        # Chunks arriving within this window are broadcast as one frame
+        self._coalesce_window = 0.02
+        # Max chunks queued for broadcast per stream before the generator waits
+        self._max_queued_chunks = 32
     
     async def stream_ai_response(self, conversation_id: str, user_id: str, 
                                prompt: str, context: str = "") -> AsyncGenerator[str, None]:
@@ -39,70 +271,79 @@ class AIStreamingManager:
         Yields:
             Response chunks as they're generated
         """
-        stream_id = f"{conversation_id}_{int(time.time())}"
+        stream_id = f"{conversation_id}_{next(_id_counter)}"
+        flusher: Optional[asyncio.Task] = None
+        chunks_sent = 0
+        response_len = 0
+        completed = False
         
         try:
             # Start typing indicator
             await self.realtime_features.start_ai_typing_indicator(conversation_id, user_id)
             
             # Track active stream
-            self.active_streams[stream_id] = {
-                "conversation_id": conversation_id,
-                "user_id": user_id,
-                "started_at": time.time(),
-                "chunks_sent": 0
-            }
+            self.active_streams[stream_id] = StreamSession(conversation_id, user_id, time.time())
             
-            # Small delay to show typing indicator
+            # Small delay to show typing indicator; the first streamed
+            # frame clears it
             await asyncio.sleep(0.5)
             
-            # Stop typing indicator before streaming
-            await self.realtime_features.stop_ai_typing_indicator(conversation_id)
-            
             # Generate streaming response
-            full_response = ""
-            chunk_buffer = ""
+            chunk_buffer: list[str] = []
+            cur_len = 0
+            loop = asyncio.get_running_loop()
+            last_send = 0.0
+            # Broadcasts run off the generator's critical path in a single
+            # flusher task, which keeps chunks in order
+            chunk_queue: asyncio.Queue = asyncio.Queue(maxsize=self._max_queued_chunks)
+            flusher = asyncio.create_task(self._flush_loop(conversation_id, chunk_queue))
             
             async for chunk in self._generate_streaming_response(prompt, context):
-                chunk_buffer += chunk
-                full_response += chunk
+                chunk_buffer.append(chunk)
+                cur_len += len(chunk)
+                response_len += len(chunk)
                 
                 # Send chunks in word boundaries for better readability
-                if len(chunk_buffer) >= 20 or chunk.endswith((' ', '.', '!', '?', '\n')):
-                    await self.realtime_features.stream_ai_response(
-                        conversation_id, chunk_buffer, False
-                    )
+                if cur_len >= 20 or (chunk and chunk[-1] in _FLUSH_CHARS):
+                    # Only wait if chunks are arriving faster than the rate cap
+                    delta = loop.time() - last_send
+                    if delta < self._min_chunk_interval:
+                        await asyncio.sleep(self._min_chunk_interval - delta)
                     
-                    self.active_streams[stream_id]["chunks_sent"] += 1
-                    chunk_buffer = ""
+                    payload = ''.join(chunk_buffer)
+                    chunk_buffer.clear()
+                    cur_len = 0
                     
-                    # Small delay between chunks for natural feel
-                    await asyncio.sleep(0.1)
+                    await self._enqueue_chunk(chunk_queue, flusher, payload)
+                    last_send = loop.time()
                     
-                    yield chunk
+                    chunks_sent += 1
+                    
+                    yield payload
             
             # Send any remaining buffer
             if chunk_buffer:
-                await self.realtime_features.stream_ai_response(
-                    conversation_id, chunk_buffer, False
-                )
-                yield chunk_buffer
+                payload = ''.join(chunk_buffer)
+                await self._enqueue_chunk(chunk_queue, flusher, payload)
+                yield payload
+            
+            # Make sure every chunk is out before the terminal frame
+            await self._enqueue_chunk(chunk_queue, flusher, None)
+            await flusher
             
             # Send completion signal
             await self.realtime_features.stream_ai_response(
                 conversation_id, "", True
             )
-            
-            logger.info("AI response streaming completed",
-                       conversation_id=conversation_id,
-                       chunks_sent=self.active_streams[stream_id]["chunks_sent"],
-                       response_length=len(full_response))
+            completed = True
             
         except Exception as e:
             logger.error("AI streaming failed", 
                         conversation_id=conversation_id,
                         error=str(e))
             
+            await self.realtime_features.stop_ai_typing_indicator(conversation_id)
+            
             # Send error to client
             await self.realtime_features.stream_ai_response(
                 conversation_id, 
@@ -112,8 +353,76 @@ class AIStreamingManager:
             
         finally:
             # Cleanup
+            if flusher is not None and not flusher.done():
+                flusher.cancel()
             self.active_streams.pop(stream_id, None)
             await self.realtime_features.stop_ai_typing_indicator(conversation_id)
+            
+            if completed:
+                logger.info("ai_stream_done",
+                           conversation_id=conversation_id,
+                           chunks=chunks_sent,
+                           response_length=response_len)
+    
+    @staticmethod
+    async def _enqueue_chunk(chunk_queue: asyncio.Queue, flusher: asyncio.Task,
+                             item: Optional[str]):
+        """
+        Queue an item for the flusher. Nothing drains the queue once the
+        flusher dies, so re-raise its error instead of blocking on a full queue.
+        """
+        if not flusher.done():
+            if not chunk_queue.full():
+                chunk_queue.put_nowait(item)
+                return
+            put = asyncio.ensure_future(chunk_queue.put(item))
+            try:
+                await asyncio.wait({put, flusher}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not put.done():
+                    put.cancel()
+            if put.done() and not put.cancelled():
+                return
+        
+        flusher.result()  # Re-raises the flusher's exception
+        raise RuntimeError("Chunk flusher exited before the stream finished")
+    
+    async def _flush_loop(self, conversation_id: str, chunk_queue: asyncio.Queue):
+        """
+        Broadcast queued chunks, coalescing those that arrive within the
+        coalescing window into a single frame. Stops on a None sentinel.
+        The first frame also carries the typing-stop transition.
+        """
+        loop = asyncio.get_running_loop()
+        done = False
+        first_frame = True
+        
+        while not done:
+            first = await chunk_queue.get()
+            if first is None:
+                break
+            
+            parts = [first]
+            deadline = loop.time() + self._coalesce_window
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    item = await asyncio.wait_for(chunk_queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                parts.append(item)
+            
+            if first_frame:
+                first_frame = False
+                await self.realtime_features.stream_ai_response_first(
+                    conversation_id, "".join(parts)
+                )
+            else:
+                await self.realtime_features.stream_ai_response(
+                    conversation_id, "".join(parts), False
+                )
     
     async def _generate_streaming_response(self, prompt: str, context: str = "") -> AsyncGenerator[str, None]:
         """
@@ -126,35 +435,57 @@ class AIStreamingManager:
         Yields:
             Response chunks
         """
+        # Prepare the full prompt with context
+        full_prompt = f"{context}\n\nUser: {prompt}\nAssistant:"
+        
         try:
-            # Prepare the full prompt with context
-            full_prompt = f"{context}\n\nUser: {prompt}\nAssistant:"
+            generation_config = genai.types.GenerationConfig(
+                temperature=0.7,
+                max_output_tokens=1000,
+            )
             
-            # Configure Gemini for streaming
-            model = genai.GenerativeModel('gemini-pro')
+            # Reuse a server-side cached prefix for long contexts
+            cached_content = await asyncio.to_thread(_get_cached_context, context) if context else None
+            if cached_content is not None:
+                model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+                request_prompt = f"User: {prompt}\nAssistant:"
+            else:
+                model = genai.GenerativeModel(STREAMING_MODEL)
+                request_prompt = full_prompt
             
-            # Generate streaming response
-            response = model.generate_content(
-                full_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7,
-                    max_output_tokens=1000,
-                    stream=True  # Enable streaming
-                )
-            )
+            # The Gemini SDK is synchronous, so stream it from a worker thread
+            # to keep the event loop free for other connections
+            chunk_queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+            stop = threading.Event()
+            worker = asyncio.create_task(asyncio.to_thread(
+                _stream_in_thread, model, request_prompt, generation_config,
+                chunk_queue, asyncio.get_running_loop(), stop
+            ))
             
-            # Stream the response
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
+            try:
+                while True:
+                    text = await chunk_queue.get()
+                    if text is None:
+                        break
+                    yield text
+                
+                # Surface any error raised by the worker
+                await worker
+            finally:
+                if not worker.done():
+                    # Consumer went away early; let the worker exit
+                    stop.set()
+                    while not chunk_queue.empty():
+                        chunk_queue.get_nowait()
                     
         except Exception as e:
             logger.error("Gemini streaming failed", error=str(e))
             
             # Fallback to non-streaming response
             try:
-                model = genai.GenerativeModel('gemini-pro')
-                response = model.generate_content(
+                model = genai.GenerativeModel(STREAMING_MODEL)
+                response = await asyncio.to_thread(
+                    model.generate_content,
                     full_prompt,
                     generation_config=genai.types.GenerationConfig(
                         temperature=0.7,
@@ -163,14 +494,10 @@ class AIStreamingManager:
                 )
                 
                 if response.text:
-                    # Simulate streaming by yielding words
+                    # Simulate streaming in chunks of 16 words
                     words = response.text.split(' ')
-                    for i, word in enumerate(words):
-                        if i == len(words) - 1:
-                            yield word
-                        else:
-                            yield word + ' '
-                        await asyncio.sleep(0.05)  # Simulate typing speed
+                    for i in range(0, len(words), 16):
+                        yield ' '.join(words[i:i + 16]) + (' ' if i + 16 < len(words) else '')
                         
             except Exception as fallback_error:
                 logger.error("Fallback response generation failed", error=str(fallback_error))
@@ -184,69 +511,75 @@ class LiveTypingIndicator:
     
     def __init__(self, realtime_features: RealTimeFeatures):
         self.realtime_features = realtime_features
-        self.typing_sessions: Dict[str, Dict] = {}
+        self.broadcaster = get_room_broadcaster(realtime_features.connection_manager)
+        # (conversation_id.int, user_id) -> session info
+        self.typing_sessions: Dict[Tuple[int, str], TypingSession] = {}
+        # One pending auto-stop timer per typing session
+        self._handles: Dict[Tuple[int, str], asyncio.TimerHandle] = {}
     
-    async def start_user_typing(self, conversation_id: str, user_id: str, user_name: str):
+    async def start_user_typing(self, conversation_id: UUID, user_id: str, user_name: str):
         """Start user typing indicator."""
-        session_id = f"{conversation_id}_{user_id}"
+        session_id = (conversation_id.int, user_id)
+        
+        # Restart the 10 second auto-stop timer
+        handle = self._handles.get(session_id)
+        if handle:
+            handle.cancel()
+        self._handles[session_id] = asyncio.get_running_loop().call_later(
+            10, lambda: asyncio.create_task(self.stop_user_typing(conversation_id, user_id))
+        )
         
+        # Debounce repeated starts from the same typist
+        session = self.typing_sessions.get(session_id)
+        if session and time.time() - session.started_at < 1.0:
+            return
+        
+        ts = _utcnow().isoformat()
         # Store typing session
-        self.typing_sessions[session_id] = {
-            "conversation_id": conversation_id,
-            "user_id": user_id,
-            "user_name": user_name,
-            "started_at": time.time()
-        }
+        self.typing_sessions[session_id] = TypingSession(
+            conversation_id, user_id, user_name, time.time()
+        )
         
         # Notify other participants
         message = {
             "type": "user_typing_start",
             "payload": {
-                "conversation_id": conversation_id,
+                "conversation_id": str(conversation_id),
                 "user_id": user_id,
                 "user_name": user_name,
                 "message": f"{user_name} is typing..."
             },
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": ts
         }
         
-        await self.realtime_features.connection_manager.broadcast_to_room(
+        self.broadcaster.broadcast(
             message, f"conversation:{conversation_id}"
         )
-        
-        # Auto-stop typing after 10 seconds
-        asyncio.create_task(self._auto_stop_typing(session_id))
     
-    async def stop_user_typing(self, conversation_id: str, user_id: str):
+    async def stop_user_typing(self, conversation_id: UUID, user_id: str):
         """Stop user typing indicator."""
-        session_id = f"{conversation_id}_{user_id}"
+        session_id = (conversation_id.int, user_id)
+        
+        handle = self._handles.pop(session_id, None)
+        if handle:
+            handle.cancel()
         
         if session_id in self.typing_sessions:
+            ts = _utcnow().isoformat()
             session = self.typing_sessions.pop(session_id)
             
             message = {
                 "type": "user_typing_stop",
                 "payload": {
-                    "conversation_id": conversation_id,
+                    "conversation_id": str(conversation_id),
                     "user_id": user_id
                 },
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": ts
             }
             
-            await self.realtime_features.connection_manager.broadcast_to_room(
+            self.broadcaster.broadcast(
                 message, f"conversation:{conversation_id}"
             )
-    
-    async def _auto_stop_typing(self, session_id: str):
-        """Automatically stop typing indicator after timeout."""
-        await asyncio.sleep(10)  # 10 seconds timeout
-        
-        if session_id in self.typing_sessions:
-            session = self.typing_sessions[session_id]
-            await self.stop_user_typing(
-                session["conversation_id"], 
-                session["user_id"]
-            )
 
 
 class LiveProgressTracker:
@@ -256,20 +589,20 @@ class LiveProgressTracker:
     
     def __init__(self, realtime_features: RealTimeFeatures):
         self.realtime_features = realtime_features
-        self.progress_sessions: Dict[str, Dict] = {}
+        self.progress_sessions: Dict[str, ProgressSession] = {}
+        self.max_sessions = 10000
+        self.session_ttl = 4 * 3600
     
     async def start_lesson_session(self, user_id: str, lesson_id: str, lesson_data: Dict[str, Any]):
         """Start tracking lesson progress."""
         session_id = f"{user_id}_{lesson_id}"
+        now = time.time()
         
-        self.progress_sessions[session_id] = {
-            "user_id": user_id,
-            "lesson_id": lesson_id,
-            "lesson_data": lesson_data,
-            "started_at": time.time(),
-            "progress": 0.0,
-            "checkpoints": []
-        }
+        self.progress_sessions.pop(session_id, None)
+        _prune_registry(self.progress_sessions, self.max_sessions - 1, self.session_ttl, now)
+        self.progress_sessions[session_id] = ProgressSession(
+            user_id, lesson_id, lesson_data, now
+        )
         
         # Notify lesson start
         await self.realtime_features.notify_lesson_started(
@@ -282,13 +615,15 @@ class LiveProgressTracker:
         session_id = f"{user_id}_{lesson_id}"
         
         if session_id in self.progress_sessions:
+            ts = _utcnow().isoformat()
+            now = time.time()
             session = self.progress_sessions[session_id]
-            session["progress"] = progress
+            session.progress = progress
             
             if checkpoint:
-                session["checkpoints"].append({
+                session.checkpoints.append({
                     "checkpoint": checkpoint,
-                    "timestamp": time.time(),
+                    "timestamp": now,
                     "progress": progress
                 })
             
@@ -299,12 +634,12 @@ class LiveProgressTracker:
                     "lesson_id": lesson_id,
                     "progress": progress,
                     "checkpoint": checkpoint,
-                    "session_duration": time.time() - session["started_at"]
+                    "session_duration": now - session.started_at
                 },
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": ts
             }
             
-            await self.realtime_features.connection_manager.send_personal_message(
+            await self.realtime_features.connection_manager.send_message_to_user(
                 message, user_id
             )
     
@@ -314,17 +649,18 @@ class LiveProgressTracker:
         session_id = f"{user_id}_{lesson_id}"
         
         if session_id in self.progress_sessions:
+            ts = _utcnow().isoformat()
             session = self.progress_sessions.pop(session_id)
             
             # Calculate session metrics
-            duration = time.time() - session["started_at"]
-            checkpoints_completed = len(session["checkpoints"])
+            duration = time.time() - session.started_at
+            checkpoints_completed = len(session.checkpoints)
             
             # Notify lesson completion
             await self.realtime_features.notify_lesson_completed(
                 user_id,
                 lesson_id,
-                session["lesson_data"]["title"],
+                session.lesson_data["title"],
                 xp_earned=50,  # Base XP, should be calculated based on lesson
                 new_progress=100.0
             )
@@ -337,12 +673,12 @@ class LiveProgressTracker:
                     "duration": duration,
                     "checkpoints_completed": checkpoints_completed,
                     "final_score": final_score,
-                    "lesson_data": session["lesson_data"]
+                    "lesson_data": session.lesson_data
                 },
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": ts
             }
             
-            await self.realtime_features.connection_manager.send_personal_message(
+            await self.realtime_features.connection_manager.send_message_to_user(
                 message, user_id
             )
 
@@ -354,35 +690,36 @@ class LiveCollaborationManager:
     
     def __init__(self, realtime_features: RealTimeFeatures):
         self.realtime_features = realtime_features
-        self.active_sessions: Dict[str, Dict] = {}
-        self.help_requests: Dict[str, Dict] = {}
+        self.broadcaster = get_room_broadcaster(realtime_features.connection_manager)
+        self.active_sessions: Dict[str, StudySession] = {}
+        self.help_requests: Dict[str, HelpRequest] = {}
+        self.max_entries = 10000
+        self.session_ttl = 2 * 3600
+        self.help_request_ttl = 3600
     
     async def create_study_session(self, creator_id: str, course_id: str, 
                                  topic: str, max_participants: int = 5) -> str:
         """Create a new study session."""
-        session_id = f"study_{int(time.time())}"
+        session_id = f"study_{next(_id_counter)}"
         
-        session_data = {
-            "id": session_id,
-            "creator_id": creator_id,
-            "course_id": course_id,
-            "topic": topic,
-            "max_participants": max_participants,
-            "participants": [creator_id],
-            "created_at": time.time(),
-            "status": "open"
-        }
+        now = time.time()
+        ts = _utcnow().isoformat()
+        _prune_registry(self.active_sessions, self.max_entries - 1, self.session_ttl, now)
+        session = StudySession(
+            session_id, creator_id, course_id, topic, max_participants,
+            [creator_id], now
+        )
         
-        self.active_sessions[session_id] = session_data
+        self.active_sessions[session_id] = session
         
         # Broadcast session creation to course participants
         message = {
             "type": "study_session_created",
-            "payload": session_data,
-            "timestamp": datetime.utcnow().isoformat()
+            "payload": asdict(session),
+            "timestamp": ts
         }
         
-        await self.realtime_features.connection_manager.broadcast_to_room(
+        self.broadcaster.broadcast(
             message, f"course:{course_id}"
         )
         
@@ -391,10 +728,11 @@ class LiveCollaborationManager:
     async def join_study_session(self, session_id: str, user_id: str, user_name: str):
         """Join an existing study session."""
         if session_id in self.active_sessions:
+            ts = _utcnow().isoformat()
             session = self.active_sessions[session_id]
             
-            if len(session["participants"]) < session["max_participants"]:
-                session["participants"].append(user_id)
+            if len(session.participants) < session.max_participants:
+                session.participants.append(user_id)
                 
                 # Notify all participants
                 message = {
@@ -403,12 +741,12 @@ class LiveCollaborationManager:
                         "session_id": session_id,
                         "user_id": user_id,
                         "user_name": user_name,
-                        "total_participants": len(session["participants"])
+                        "total_participants": len(session.participants)
                     },
-                    "timestamp": datetime.utcnow().isoformat()
+                    "timestamp": ts
                 }
                 
-                await self.realtime_features.connection_manager.broadcast_to_room(
+                self.broadcaster.broadcast(
                     message, f"study_session:{session_id}"
                 )
                 
@@ -419,20 +757,13 @@ class LiveCollaborationManager:
     async def request_peer_help(self, user_id: str, course_id: str, lesson_id: str, 
                               question: str, urgency: str = "normal") -> str:
         """Request help from peers."""
-        request_id = f"help_{int(time.time())}"
-        
-        help_data = {
-            "id": request_id,
-            "user_id": user_id,
-            "course_id": course_id,
-            "lesson_id": lesson_id,
-            "question": question,
-            "urgency": urgency,
-            "created_at": time.time(),
-            "responses": []
-        }
+        request_id = f"help_{next(_id_counter)}"
         
-        self.help_requests[request_id] = help_data
+        now = time.time()
+        _prune_registry(self.help_requests, self.max_entries - 1, self.help_request_ttl, now)
+        self.help_requests[request_id] = HelpRequest(
+            request_id, user_id, course_id, lesson_id, question, urgency, now
+        )
         
         # Broadcast help request to course participants
         await self.realtime_features.request_peer_help(
@@ -445,6 +776,7 @@ class LiveCollaborationManager:
                                     helper_name: str, response: str):
         """Respond to a peer help request."""
         if request_id in self.help_requests:
+            ts = _utcnow().isoformat()
             help_request = self.help_requests[request_id]
             
             response_data = {
@@ -454,7 +786,7 @@ class LiveCollaborationManager:
                 "timestamp": time.time()
             }
             
-            help_request["responses"].append(response_data)
+            help_request.responses.append(response_data)
             
             # Notify the person who requested help
             message = {
@@ -463,54 +795,37 @@ class LiveCollaborationManager:
                     "request_id": request_id,
                     "helper_name": helper_name,
                     "response": response,
-                    "total_responses": len(help_request["responses"])
+                    "total_responses": len(help_request.responses)
                 },
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": ts
             }
             
-            await self.realtime_features.connection_manager.send_personal_message(
-                message, help_request["user_id"]
+            await self.realtime_features.connection_manager.send_message_to_user(
+                message, help_request.user_id
             )
 
 
-# Global managers
-_streaming_manager: Optional[AIStreamingManager] = None
-_typing_indicator: Optional[LiveTypingIndicator] = None
-_progress_tracker: Optional[LiveProgressTracker] = None
-_collaboration_manager: Optional[LiveCollaborationManager] = None
-
-
+# Global managers, one per connection manager. lru_cache makes creation
+# thread-safe without module-level globals.
+@lru_cache(maxsize=None)
 def get_streaming_manager(connection_manager) -> AIStreamingManager:
     """Get the AI streaming manager."""
-    global _streaming_manager
-    if _streaming_manager is None:
-        realtime_features = get_realtime_features(connection_manager)
-        _streaming_manager = AIStreamingManager(realtime_features)
-    return _streaming_manager
+    return AIStreamingManager(get_realtime_features(connection_manager))
 
 
+@lru_cache(maxsize=None)
 def get_typing_indicator(connection_manager) -> LiveTypingIndicator:
     """Get the typing indicator manager."""
-    global _typing_indicator
-    if _typing_indicator is None:
-        realtime_features = get_realtime_features(connection_manager)
-        _typing_indicator = LiveTypingIndicator(realtime_features)
-    return _typing_indicator
+    return LiveTypingIndicator(get_realtime_features(connection_manager))
 
 
+@lru_cache(maxsize=None)
 def get_progress_tracker(connection_manager) -> LiveProgressTracker:
     """Get the progress tracker."""
-    global _progress_tracker
-    if _progress_tracker is None:
-        realtime_features = get_realtime_features(connection_manager)
-        _progress_tracker = LiveProgressTracker(realtime_features)
-    return _progress_tracker
+    return LiveProgressTracker(get_realtime_features(connection_manager))
 
 
+@lru_cache(maxsize=None)
 def get_collaboration_manager(connection_manager) -> LiveCollaborationManager:
     """Get the collaboration manager."""
-    global _collaboration_manager
-    if _collaboration_manager is None:
-        realtime_features = get_realtime_features(connection_manager)
-        _collaboration_manager = LiveCollaborationManager(realtime_features)
-    return _collaboration_manager 
\ No newline at end of file
+    return LiveCollaborationManager(get_realtime_features(connection_manager))
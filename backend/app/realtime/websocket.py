@@ -3,12 +3,15 @@ WebSocket implementation for real-time notifications and updates.
 Handles real-time XP updates, forum notifications, and system alerts.
 """
 
-import json
+import asyncio
 import os
-from typing import Dict, Set, List
+import time
+from functools import lru_cache
+from typing import Dict, Set, List, Optional, Tuple, Union
+import msgspec
+import orjson
 import structlog
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Depends
-from fastapi.websockets import WebSocketState
 import jwt
 from supabase import create_client, Client
 from datetime import datetime
@@ -19,24 +22,104 @@ logger = structlog.get_logger()
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_ANON_KEY")
 supabase: Client = create_client(supabase_url, supabase_key)
+# Supabase signs access tokens with this secret; when set, tokens are verified locally
+supabase_jwt_secret = os.getenv("SUPABASE_JWT_SECRET")
 
 router = APIRouter()
 
 
+# Clients that offer this subprotocol get MessagePack binary frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "msgpack"
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_msgpack_decoder = msgspec.msgpack.Decoder()
+
+
+def _encode(message: dict) -> str:
+    """Serialize an outbound message to JSON text (datetimes become ISO strings)."""
+    return orjson.dumps(message).decode()
+
+
+# How long a connection's cached course enrollments are trusted
+ENROLLMENT_CACHE_TTL = 300
+
+
+def _load_enrolled_courses(user_id: str) -> frozenset:
+    """Fetch the ids of all courses a user is enrolled in."""
+    rows = supabase.table("course_enrollments").select("course_id").eq(
+        "user_id", user_id
+    ).execute()
+    return frozenset(str(row["course_id"]) for row in rows.data or [])
+
+
+async def _refresh_enrolled_courses(user_info: dict):
+    """Cache the user's enrolled course ids on their connection info."""
+    try:
+        user_info["courses"] = await asyncio.to_thread(_load_enrolled_courses, user_info["sub"])
+    except Exception as e:
+        logger.error("Failed to load course enrollments", user_id=user_info["sub"], error=str(e))
+        user_info["courses"] = frozenset()
+    user_info["courses_loaded_at"] = time.monotonic()
+
+
+# Notification timestamp, re-rendered at most every 100ms: (iso_string, refreshed_at)
+_ts_cache = ["", 0.0]
+
+
+def _timestamp() -> str:
+    """Current UTC time as an ISO-8601 string, accurate to about 100ms."""
+    now = time.monotonic()
+    if now - _ts_cache[1] >= 0.1:
+        _ts_cache[0] = datetime.utcnow().isoformat()
+        _ts_cache[1] = now
+    return _ts_cache[0]
+
+
+def _json_to_msgpack(payload: str) -> bytes:
+    """Re-encode pre-serialized JSON text as MessagePack."""
+    return _msgpack_encoder.encode(orjson.loads(payload))
+
+
+class ConnEntry:
+    """Per-connection state: the user's identity plus the outbound writer."""
+    
+    __slots__ = ("user_id", "email", "role", "org_id", "full_name", "msgpack", "queue", "writer")
+    
+    def __init__(self, user_info: dict, msgpack: bool, queue: asyncio.Queue):
+        self.user_id: str = user_info["sub"]
+        self.email: Optional[str] = user_info.get("email")
+        self.role: Optional[str] = user_info.get("role")
+        self.org_id: Optional[str] = user_info.get("org_id")
+        self.full_name: Optional[str] = user_info.get("full_name")
+        self.msgpack = msgpack
+        self.queue = queue
+        self.writer: Optional[asyncio.Task] = None
+
+
 class ConnectionManager:
     """Manages WebSocket connections."""
     
-    def __init__(self):
+    def __init__(self, outbound_buffer: int = 64):
         # Active connections: user_id -> Set[WebSocket]
         self.active_connections: Dict[str, Set[WebSocket]] = {}
-        # Connection metadata: WebSocket -> user info
-        self.connection_metadata: Dict[WebSocket, dict] = {}
+        # Connection metadata: WebSocket -> ConnEntry. A socket has an entry
+        # exactly while it is connected.
+        self.connection_metadata: Dict[WebSocket, ConnEntry] = {}
         # Room subscriptions: room_name -> Set[user_id]
         self.room_subscriptions: Dict[str, Set[str]] = {}
+        # Room sockets: room_name -> Set[WebSocket], kept in step with the
+        # subscriptions so broadcasts need a single lookup
+        self.room_websockets: Dict[str, Set[WebSocket]] = {}
+        # Reverse index: user_id -> Set[room_name]
+        self.user_rooms: Dict[str, Set[str]] = {}
+        # Open sockets across all users, kept as a counter for logging
+        self._total_connections = 0
+        # Max frames queued per connection before it is evicted
+        self.outbound_buffer = outbound_buffer
     
-    async def connect(self, websocket: WebSocket, user_id: str, user_info: dict):
+    async def connect(self, websocket: WebSocket, user_id: str, user_info: dict,
+                      subprotocol: Optional[str] = None):
         """Accept new WebSocket connection."""
-        await websocket.accept()
+        await websocket.accept(subprotocol=subprotocol)
         
         # Add to active connections
         if user_id not in self.active_connections:
@@ -44,13 +127,26 @@ class ConnectionManager:
         self.active_connections[user_id].add(websocket)
         
         # Store metadata
-        self.connection_metadata[websocket] = user_info
+        entry = ConnEntry(
+            user_info,
+            msgpack=subprotocol == MSGPACK_SUBPROTOCOL,
+            queue=asyncio.Queue(maxsize=self.outbound_buffer)
+        )
+        self.connection_metadata[websocket] = entry
+        self._total_connections += 1
+        
+        # Join the rooms this user is already subscribed to
+        for room in self.user_rooms.get(user_id, ()):
+            self.room_websockets[room].add(websocket)
+        
+        # Start the writer for this connection
+        entry.writer = asyncio.create_task(self._writer(websocket, entry))
         
         logger.info(
             "WebSocket connection established",
             user_id=user_id,
-            email=user_info.get("email"),
-            total_connections=sum(len(conns) for conns in self.active_connections.values())
+            email=entry.email,
+            total_connections=self._total_connections
         )
         
         # Send welcome message
@@ -62,69 +158,154 @@ class ConnectionManager:
     
     def disconnect(self, websocket: WebSocket):
         """Remove WebSocket connection."""
-        user_info = self.connection_metadata.get(websocket)
-        if not user_info:
+        entry = self.connection_metadata.pop(websocket, None)
+        if entry is None:
             return
+        self._total_connections -= 1
         
-        user_id = user_info["sub"]
+        user_id = entry.user_id
+        
+        # Stop the writer
+        if entry.writer is not None and entry.writer is not asyncio.current_task():
+            entry.writer.cancel()
         
         # Remove from active connections
+        last_connection = True
         if user_id in self.active_connections:
             self.active_connections[user_id].discard(websocket)
-            if not self.active_connections[user_id]:
+            if self.active_connections[user_id]:
+                last_connection = False
+            else:
                 del self.active_connections[user_id]
         
-        # Remove from connection metadata
-        self.connection_metadata.pop(websocket, None)
-        
-        # Remove from room subscriptions
-        for room_users in self.room_subscriptions.values():
-            room_users.discard(user_id)
+        # Remove from room sockets, and from room subscriptions once the
+        # user's last connection is gone
+        if last_connection:
+            rooms = self.user_rooms.pop(user_id, ())
+        else:
+            rooms = self.user_rooms.get(user_id, ())
+        for room in rooms:
+            self.room_websockets[room].discard(websocket)
+            if last_connection:
+                room_users = self.room_subscriptions[room]
+                room_users.discard(user_id)
+                if not room_users:
+                    del self.room_subscriptions[room]
+                    del self.room_websockets[room]
         
         logger.info(
             "WebSocket connection closed",
             user_id=user_id,
-            email=user_info.get("email"),
-            remaining_connections=sum(len(conns) for conns in self.active_connections.values())
+            email=entry.email,
+            remaining_connections=self._total_connections
         )
     
-    async def send_personal_message(self, message: dict, websocket: WebSocket):
-        """Send message to specific WebSocket connection."""
+    async def _writer(self, websocket: WebSocket, entry: ConnEntry):
+        """Drain a connection's outbound queue onto the socket."""
+        send = websocket.send_bytes if entry.msgpack else websocket.send_text
+        queue = entry.queue
+        
         try:
-            if websocket.client_state == WebSocketState.CONNECTED:
-                await websocket.send_text(json.dumps(message))
+            while True:
+                payload = await queue.get()
+                await send(payload)
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             logger.error("Failed to send WebSocket message", error=str(e))
+            self.disconnect(websocket)
     
-    async def send_message_to_user(self, message: dict, user_id: str):
-        """Send message to all connections of a specific user."""
-        if user_id in self.active_connections:
-            disconnected_sockets = []
-            for websocket in self.active_connections[user_id].copy():
-                try:
-                    if websocket.client_state == WebSocketState.CONNECTED:
-                        await websocket.send_text(json.dumps(message))
-                    else:
-                        disconnected_sockets.append(websocket)
-                except Exception as e:
-                    logger.error("Failed to send message to user", user_id=user_id, error=str(e))
-                    disconnected_sockets.append(websocket)
-            
-            # Clean up disconnected sockets
-            for websocket in disconnected_sockets:
-                self.disconnect(websocket)
+    def _enqueue(self, websocket: WebSocket, payload: Union[str, bytes]):
+        """
+        Queue a payload for a connection without waiting. A client whose
+        buffer is full is too slow to keep up and gets disconnected.
+        """
+        entry = self.connection_metadata.get(websocket)
+        if entry is None:
+            return
+        
+        try:
+            entry.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self._evict(websocket, entry)
+    
+    def _evict(self, websocket: WebSocket, entry: ConnEntry):
+        """Disconnect and close a client that can't keep up."""
+        logger.warning("Evicting slow WebSocket consumer", user_id=entry.user_id)
+        self.disconnect(websocket)
+        asyncio.create_task(websocket.close(code=1013, reason="Too slow"))
+    
+    async def send_personal_message(self, message: dict, websocket: WebSocket):
+        """Send message to specific WebSocket connection."""
+        entry = self.connection_metadata.get(websocket)
+        if entry is None:
+            return
+        
+        if entry.msgpack:
+            self._enqueue(websocket, _msgpack_encoder.encode(message))
+        else:
+            self._enqueue(websocket, _encode(message))
+    
+    async def send_message_to_user(self, message: Union[dict, str], user_id: str):
+        """Send a message dict or pre-serialized JSON text to all connections of a user."""
+        payload = message if isinstance(message, str) else _encode(message)
+        await self._send_payload_to_user(payload, user_id)
+    
+    async def _send_payload_to_user(self, payload: str, user_id: str):
+        """Send an already-serialized message to all connections of a user."""
+        connections = self.active_connections.get(user_id)
+        if connections:
+            self._send_payload(payload, tuple(connections))
+    
+    def _send_payload(self, payload: str, websockets: Tuple[WebSocket, ...]):
+        """
+        Queue an already-serialized message on several sockets. Each
+        socket's writer sends on its own, so a slow client only holds up
+        itself. MessagePack clients get the payload re-encoded once.
+        """
+        # The metadata registry doubles as the liveness check: a socket is
+        # removed from it the moment it disconnects
+        connections = self.connection_metadata
+        binary_payload = None
+        for websocket in websockets:
+            entry = connections.get(websocket)
+            if entry is None:
+                continue
+            frame = payload
+            if entry.msgpack:
+                if binary_payload is None:
+                    binary_payload = _json_to_msgpack(payload)
+                frame = binary_payload
+            try:
+                entry.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._evict(websocket, entry)
     
     async def send_message_to_room(self, message: dict, room: str):
         """Send message to all users in a room."""
-        if room in self.room_subscriptions:
-            for user_id in self.room_subscriptions[room].copy():
-                await self.send_message_to_user(message, user_id)
+        await self.broadcast_to_room(message, room)
+    
+    async def broadcast_to_room(self, message: Union[dict, str], room: str):
+        """
+        Broadcast a message to all users in a room.
+        
+        Accepts a message dict or pre-serialized JSON text; either way the
+        payload is encoded once and the same string is sent to every socket.
+        """
+        websockets = self.room_websockets.get(room)
+        if websockets:
+            payload = message if isinstance(message, str) else _encode(message)
+            # Snapshot: evicting a slow consumer mutates the room's socket set
+            self._send_payload(payload, tuple(websockets))
     
     async def subscribe_to_room(self, user_id: str, room: str):
         """Subscribe user to a room."""
         if room not in self.room_subscriptions:
             self.room_subscriptions[room] = set()
+            self.room_websockets[room] = set()
         self.room_subscriptions[room].add(user_id)
+        self.room_websockets[room].update(self.active_connections.get(user_id, ()))
+        self.user_rooms.setdefault(user_id, set()).add(room)
         
         logger.info("User subscribed to room", user_id=user_id, room=room)
     
@@ -132,8 +313,16 @@ class ConnectionManager:
         """Unsubscribe user from a room."""
         if room in self.room_subscriptions:
             self.room_subscriptions[room].discard(user_id)
+            self.room_websockets[room].difference_update(self.active_connections.get(user_id, ()))
             if not self.room_subscriptions[room]:
                 del self.room_subscriptions[room]
+                del self.room_websockets[room]
+        
+        user_rooms = self.user_rooms.get(user_id)
+        if user_rooms is not None:
+            user_rooms.discard(room)
+            if not user_rooms:
+                del self.user_rooms[user_id]
         
         logger.info("User unsubscribed from room", user_id=user_id, room=room)
     
@@ -143,12 +332,11 @@ class ConnectionManager:
         for user_id, connections in self.active_connections.items():
             if connections:  # Has active connections
                 # Get user info from any connection
-                websocket = next(iter(connections))
-                user_info = self.connection_metadata.get(websocket, {})
+                entry = self.connection_metadata[next(iter(connections))]
                 active_users.append({
                     "user_id": user_id,
-                    "email": user_info.get("email"),
-                    "full_name": user_info.get("full_name"),
+                    "email": entry.email,
+                    "full_name": entry.full_name,
                     "connections": len(connections)
                 })
         return active_users
@@ -158,11 +346,37 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+@lru_cache(maxsize=4096)
+def _decode_token(token: str) -> dict:
+    """Verify a Supabase access token's signature and claims locally."""
+    return jwt.decode(
+        token,
+        supabase_jwt_secret,
+        algorithms=["HS256"],
+        audience="authenticated"
+    )
+
+
 async def verify_websocket_token(token: str) -> dict:
     """Verify WebSocket authentication token."""
+    if supabase_jwt_secret:
+        try:
+            claims = _decode_token(token)
+            # Cached claims outlive the decode, so re-check expiry on every hit
+            if claims.get("exp", 0) > time.time():
+                return {
+                    "sub": claims["sub"],
+                    "email": claims.get("email"),
+                    "role": "learner",  # Simplified - avoid DB query for now
+                    "org_id": None,
+                    "full_name": claims.get("email"),
+                }
+        except jwt.InvalidTokenError:
+            pass  # Fall back to asking Supabase
+    
     try:
         # Verify token with Supabase (simplified to avoid DB pool issues)
-        response = supabase.auth.get_user(token)
+        response = await asyncio.to_thread(supabase.auth.get_user, token)
         if response.user:
             user_data = {
                 "sub": response.user.id,
@@ -185,14 +399,25 @@ async def websocket_notifications(websocket: WebSocket, token: str):
     """
     WebSocket endpoint for real-time notifications.
     URL: /ws/notifications?token=<jwt_token>
+    
+    Clients offering the "msgpack" subprotocol exchange MessagePack binary
+    frames; everyone else uses JSON text.
     """
     try:
         # Verify authentication
         user_info = await verify_websocket_token(token)
         user_id = user_info["sub"]
         
+        use_msgpack = MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        
         # Connect to manager
-        await manager.connect(websocket, user_id, user_info)
+        await manager.connect(
+            websocket, user_id, user_info,
+            subprotocol=MSGPACK_SUBPROTOCOL if use_msgpack else None
+        )
+        
+        # Load enrollments once so course room checks don't hit the database
+        await _refresh_enrolled_courses(user_info)
         
         # Auto-subscribe to user's personal room
         await manager.subscribe_to_room(user_id, f"user_{user_id}")
@@ -204,18 +429,25 @@ async def websocket_notifications(websocket: WebSocket, token: str):
         # Handle messages
         while True:
             try:
-                data = await websocket.receive_text()
-                message = json.loads(data)
+                if use_msgpack:
+                    message = _msgpack_decoder.decode(await websocket.receive_bytes())
+                else:
+                    message = orjson.loads(await websocket.receive_text())
                 
                 await handle_websocket_message(websocket, user_info, message)
                 
             except WebSocketDisconnect:
                 break
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 await manager.send_personal_message({
                     "type": "error",
                     "message": "Invalid JSON format"
                 }, websocket)
+            except msgspec.DecodeError:
+                await manager.send_personal_message({
+                    "type": "error",
+                    "message": "Invalid MessagePack format"
+                }, websocket)
             except Exception as e:
                 logger.error("Error handling WebSocket message", error=str(e))
                 await manager.send_personal_message({
@@ -303,15 +535,15 @@ async def can_access_room(user_info: dict, room: str) -> bool:
         return True
     
     if room.startswith("course_"):
-        # Check if user is enrolled in the course
+        # Check the enrollments cached at connect time, reloading them if
+        # they're stale so new enrollments are picked up
         course_id = room.split("_")[1]
-        try:
-            enrollment = supabase.table("course_enrollments").select("id").eq(
-                "user_id", user_info["sub"]
-            ).eq("course_id", course_id).single().execute()
-            return enrollment.data is not None
-        except:
-            return False
+        if course_id in user_info.get("courses", ()):
+            return True
+        if time.monotonic() - user_info.get("courses_loaded_at", 0) > ENROLLMENT_CACHE_TTL:
+            await _refresh_enrolled_courses(user_info)
+            return course_id in user_info["courses"]
+        return False
     
     if room.startswith("forum_"):
         # For forum rooms, allow access if user is in the organization
@@ -322,69 +554,96 @@ async def can_access_room(user_info: dict, room: str) -> bool:
 
 
 # Utility functions for sending notifications
+#
+# Notification payloads are msgspec Structs; the "type" field is the struct
+# tag, and the JSON encoder compiles a dedicated serializer per struct.
+
+class XPNotification(msgspec.Struct, tag_field="type", tag="xp_earned"):
+    xp_earned: int
+    source: str
+    level_up: bool
+    timestamp: str
+
+
+class BadgeNotification(msgspec.Struct, tag_field="type", tag="badge_earned"):
+    badge_name: str
+    badge_description: str
+    timestamp: str
+
+
+class ForumNotification(msgspec.Struct, tag_field="type", tag="forum_notification"):
+    notification_type: str  # "new_answer", "question_answered", etc.
+    question_title: str
+    question_id: str
+    timestamp: str
+
+
+class CourseNotification(msgspec.Struct, tag_field="type", tag="course_notification"):
+    notification_type: str  # "new_course", "course_completed", etc.
+    course_title: str
+    course_id: str
+    timestamp: str
+
+
+class SystemNotification(msgspec.Struct, tag_field="type", tag="system_notification"):
+    title: str
+    message: str
+    priority: str  # "low", "normal", "high", "urgent"
+    timestamp: str
+
+
+_json_encoder = msgspec.json.Encoder()
+
+
+def _encode_struct(notification: msgspec.Struct) -> str:
+    """Serialize a notification struct to JSON text."""
+    return _json_encoder.encode(notification).decode()
+
 
 async def send_xp_notification(user_id: str, xp_earned: int, source: str, level_up: bool = False):
     """Send XP earned notification to user."""
-    message = {
-        "type": "xp_earned",
-        "xp_earned": xp_earned,
-        "source": source,
-        "level_up": level_up,
-        "timestamp": json.dumps(datetime.utcnow().isoformat())
-    }
-    
-    await manager.send_message_to_user(message, user_id)
+    notification = XPNotification(
+        xp_earned=xp_earned, source=source, level_up=level_up, timestamp=_timestamp()
+    )
+    await manager.send_message_to_user(_encode_struct(notification), user_id)
 
 
 async def send_badge_notification(user_id: str, badge_name: str, badge_description: str):
     """Send badge earned notification to user."""
-    message = {
-        "type": "badge_earned",
-        "badge_name": badge_name,
-        "badge_description": badge_description,
-        "timestamp": json.dumps(datetime.utcnow().isoformat())
-    }
-    
-    await manager.send_message_to_user(message, user_id)
+    notification = BadgeNotification(
+        badge_name=badge_name, badge_description=badge_description, timestamp=_timestamp()
+    )
+    await manager.send_message_to_user(_encode_struct(notification), user_id)
 
 
 async def send_forum_notification(user_id: str, notification_type: str, question_title: str, question_id: str):
     """Send forum notification to user."""
-    message = {
-        "type": "forum_notification",
-        "notification_type": notification_type,  # "new_answer", "question_answered", etc.
-        "question_title": question_title,
-        "question_id": question_id,
-        "timestamp": json.dumps(datetime.utcnow().isoformat())
-    }
-    
-    await manager.send_message_to_user(message, user_id)
+    notification = ForumNotification(
+        notification_type=notification_type,
+        question_title=question_title,
+        question_id=question_id,
+        timestamp=_timestamp()
+    )
+    await manager.send_message_to_user(_encode_struct(notification), user_id)
 
 
 async def send_course_notification(user_id: str, course_title: str, course_id: str, notification_type: str):
     """Send course-related notification to user."""
-    message = {
-        "type": "course_notification",
-        "notification_type": notification_type,  # "new_course", "course_completed", etc.
-        "course_title": course_title,
-        "course_id": course_id,
-        "timestamp": json.dumps(datetime.utcnow().isoformat())
-    }
-    
-    await manager.send_message_to_user(message, user_id)
+    notification = CourseNotification(
+        notification_type=notification_type,
+        course_title=course_title,
+        course_id=course_id,
+        timestamp=_timestamp()
+    )
+    await manager.send_message_to_user(_encode_struct(notification), user_id)
 
 
 async def send_system_notification(room: str, title: str, message: str, priority: str = "normal"):
     """Send system notification to a room."""
-    notification = {
-        "type": "system_notification",
-        "title": title,
-        "message": message,
-        "priority": priority,  # "low", "normal", "high", "urgent"
-        "timestamp": json.dumps(datetime.utcnow().isoformat())
-    }
-    
-    await manager.send_message_to_room(notification, room)
+    notification = SystemNotification(
+        title=title, message=message, priority=priority, timestamp=_timestamp()
+    )
+    await manager.broadcast_to_room(_encode_struct(notification), room)
 
 
 # Export the router as websocket_router for main.py
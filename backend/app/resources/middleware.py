@@ -0,0 +1,38 @@
+"""
+Upload size middleware for K-Orbit API.
+Rejects oversized uploads from their Content-Length before the body is read.
+"""
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Pure ASGI middleware that answers 413 for a POST to ``path`` whose
+    Content-Length exceeds ``max_bytes``.
+
+    FastAPI parses a multipart form (spooling the whole file) before the
+    endpoint runs, so this check has to happen ahead of the router. The
+    endpoint's chunked size check still covers requests without the header.
+    """
+
+    def __init__(self, app: ASGIApp, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.path:
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_bytes:
+                        response = JSONResponse(
+                            {"detail": f"File size exceeds maximum limit of {self.max_bytes // (1024*1024)}MB"},
+                            status_code=413
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+
+        await self.app(scope, receive, send)
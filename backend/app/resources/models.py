@@ -5,7 +5,13 @@ Pydantic models for file uploads, document processing, and knowledge management.
 
 from datetime import datetime
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel, Field
+import numpy as np
+import orjson
+from pydantic import BaseModel, Field, validator
+
+# Embeddings are held as packed little-endian float16: 1.5KB for a 768-dim
+# vector instead of ~22KB as a list of Python floats
+EMBEDDING_DTYPE = np.dtype("<f2")
 
 
 class FileUploadResponse(BaseModel):
@@ -18,6 +24,8 @@ class FileUploadResponse(BaseModel):
     url: str = Field(..., description="File URL")
     is_processed: bool = Field(..., description="Whether file has been processed")
     uploaded_at: datetime = Field(..., description="Upload timestamp")
+    
+    model_config = {"frozen": True}
 
 
 class DocumentProcessingResponse(BaseModel):
@@ -27,6 +35,8 @@ class DocumentProcessingResponse(BaseModel):
     extracted_text_length: Optional[int] = Field(None, description="Length of extracted text")
     processing_time_ms: Optional[int] = Field(None, description="Processing time in milliseconds")
     error_message: Optional[str] = Field(None, description="Error message if processing failed")
+    
+    model_config = {"frozen": True}
 
 
 class KnowledgeDocumentResponse(BaseModel):
@@ -39,6 +49,8 @@ class KnowledgeDocumentResponse(BaseModel):
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Additional metadata")
     created_at: datetime = Field(..., description="Creation timestamp")
     updated_at: datetime = Field(..., description="Last update timestamp")
+    
+    model_config = {"frozen": True}
 
 
 class CreateKnowledgeDocumentRequest(BaseModel):
@@ -46,6 +58,8 @@ class CreateKnowledgeDocumentRequest(BaseModel):
     title: str = Field(..., min_length=1, max_length=255, description="Document title")
     content: str = Field(..., min_length=1, description="Document content")
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Additional metadata")
+    
+    model_config = {"frozen": True}
 
 
 class UpdateKnowledgeDocumentRequest(BaseModel):
@@ -53,6 +67,8 @@ class UpdateKnowledgeDocumentRequest(BaseModel):
     title: str = Field(..., min_length=1, max_length=255, description="Document title")
     content: str = Field(..., min_length=1, description="Document content")
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Additional metadata")
+    
+    model_config = {"frozen": True}
 
 
 class DocumentSearchRequest(BaseModel):
@@ -61,6 +77,8 @@ class DocumentSearchRequest(BaseModel):
     source_type: Optional[str] = Field(None, description="Filter by source type")
     page: int = Field(1, ge=1, description="Page number")
     limit: int = Field(20, ge=1, le=100, description="Items per page")
+    
+    model_config = {"frozen": True}
 
 
 class DocumentSearchResponse(BaseModel):
@@ -70,6 +88,8 @@ class DocumentSearchResponse(BaseModel):
     page: int = Field(..., description="Current page")
     limit: int = Field(..., description="Items per page")
     has_more: bool = Field(..., description="Whether there are more results")
+    
+    model_config = {"frozen": True}
 
 
 class FileUpload(BaseModel):
@@ -85,6 +105,8 @@ class FileUpload(BaseModel):
     is_processed: bool = Field(default=False, description="Processing status")
     metadata: Dict[str, Any] = Field(default_factory=dict, description="File metadata")
     created_at: datetime = Field(..., description="Upload timestamp")
+    
+    model_config = {"frozen": True}
 
 
 class KnowledgeDocument(BaseModel):
@@ -95,16 +117,35 @@ class KnowledgeDocument(BaseModel):
     source_type: str = Field(..., description="Source type")
     source_id: Optional[str] = Field(None, description="Source ID")
     org_id: str = Field(..., description="Organization ID")
-    embedding: Optional[List[float]] = Field(None, description="Document embedding vector")
+    embedding: Optional[bytes] = Field(None, description="Document embedding vector (packed float16)")
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Document metadata")
     created_at: datetime = Field(..., description="Creation timestamp")
     updated_at: datetime = Field(..., description="Last update timestamp")
+    
+    model_config = {"frozen": True, "ser_json_bytes": "base64"}
+    
+    @validator("embedding", pre=True)
+    def pack_embedding(cls, v):
+        """Accept a list of floats or pgvector text and pack it as float16 bytes."""
+        if v is None or isinstance(v, bytes):
+            return v
+        if isinstance(v, str):
+            v = orjson.loads(v)
+        return np.asarray(v, dtype=EMBEDDING_DTYPE).tobytes()
+    
+    def embedding_array(self) -> Optional[np.ndarray]:
+        """Zero-copy float16 view of the embedding."""
+        if self.embedding is None:
+            return None
+        return np.frombuffer(self.embedding, dtype=EMBEDDING_DTYPE)
 
 
 class EmbeddingRequest(BaseModel):
     """Request model for generating embeddings."""
     text: str = Field(..., min_length=1, description="Text to embed")
     task_type: str = Field(default="retrieval_document", description="Task type for embedding")
+    
+    model_config = {"frozen": True}
 
 
 class EmbeddingResponse(BaseModel):
@@ -113,6 +154,8 @@ class EmbeddingResponse(BaseModel):
     dimension: int = Field(..., description="Embedding dimension")
     model: str = Field(..., description="Model used for embedding")
     processing_time_ms: int = Field(..., description="Processing time in milliseconds")
+    
+    model_config = {"frozen": True}
 
 
 class DocumentAnalyticsResponse(BaseModel):
@@ -122,12 +165,16 @@ class DocumentAnalyticsResponse(BaseModel):
     recent_uploads: List[FileUploadResponse] = Field(..., description="Recent uploads")
     most_accessed: List[KnowledgeDocumentResponse] = Field(..., description="Most accessed documents")
     storage_usage_bytes: int = Field(..., description="Total storage usage in bytes")
+    
+    model_config = {"frozen": True}
 
 
 class BulkUploadRequest(BaseModel):
     """Request model for bulk upload operations."""
     source_urls: List[str] = Field(..., description="List of URLs to import")
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Metadata for all uploads")
+    
+    model_config = {"frozen": True}
 
 
 class BulkUploadResponse(BaseModel):
@@ -136,6 +183,8 @@ class BulkUploadResponse(BaseModel):
     successfully_uploaded: int = Field(..., description="Number of successful uploads")
     failed_uploads: List[Dict[str, str]] = Field(..., description="Failed uploads with errors")
     upload_ids: List[str] = Field(..., description="IDs of successful uploads")
+    
+    model_config = {"frozen": True}
 
 
 class DocumentValidationResponse(BaseModel):
@@ -144,6 +193,8 @@ class DocumentValidationResponse(BaseModel):
     issues: List[str] = Field(default_factory=list, description="Validation issues found")
     suggestions: List[str] = Field(default_factory=list, description="Improvement suggestions")
     quality_score: float = Field(..., description="Document quality score (0-1)")
+    
+    model_config = {"frozen": True}
 
 
 class ResourceHealthResponse(BaseModel):
@@ -152,4 +203,6 @@ class ResourceHealthResponse(BaseModel):
     service: str = Field(..., description="Service name")
     timestamp: datetime = Field(..., description="Health check timestamp")
     storage_connectivity: bool = Field(..., description="Storage service connectivity")
-    database_connectivity: bool = Field(..., description="Database connectivity") 
\ No newline at end of file
+    database_connectivity: bool = Field(..., description="Database connectivity")
+    
+    model_config = {"frozen": True}
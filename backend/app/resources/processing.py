@@ -0,0 +1,427 @@
+"""
+Document processing for K-Orbit resources.
+Extracts text from uploaded files, generates embeddings and stores knowledge documents.
+Runs as a FastAPI background task or on the Celery document-processing queue.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import structlog
+from supabase import create_client, Client
+
+logger = structlog.get_logger()
+
+supabase_url = os.getenv("SUPABASE_URL")
+supabase_key = os.getenv("SUPABASE_ANON_KEY")
+
+
+@lru_cache(maxsize=None)
+def _supabase_for_process(pid: int) -> Client:
+    return create_client(supabase_url, supabase_key)
+
+
+def get_supabase() -> Client:
+    """
+    Supabase client for the current process, created on first use. Keyed on
+    the PID so forked Celery workers build their own client (and HTTP
+    connection pool) instead of sharing the parent's.
+    """
+    return _supabase_for_process(os.getpid())
+
+
+def iso_now() -> str:
+    """Current UTC time as an ISO 8601 string, without building a datetime."""
+    t = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + f".{int(t % 1 * 1e6):06d}Z"
+
+
+# PDFs with more pages than this are extracted on several threads, in
+# batches of PDF_PAGE_BATCH pages
+PDF_PARALLEL_MIN_PAGES = 32
+PDF_PAGE_BATCH = 8
+PDF_MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _join_until(parts, max_chars: int) -> str:
+    """Join text parts with newlines, stopping once max_chars is reached."""
+    collected = []
+    total = 0
+    for part in parts:
+        collected.append(part)
+        total += len(part) + 1
+        if total >= max_chars:
+            break
+    return "\n".join(collected)[:max_chars]
+
+
+def _extract_pdf_pages(content: bytes, start: int, stop: int) -> str:
+    """Extract a page range. Each call opens its own document since fitz.Document isn't thread-safe."""
+    import fitz
+    
+    with fitz.open(stream=content, filetype="pdf") as doc:
+        return "\n".join(doc.load_page(i).get_text("text") for i in range(start, stop))
+
+
+def _extract_pdf_text(content: bytes, max_chars: int) -> str:
+    """
+    Extract up to max_chars of text from a PDF with PyMuPDF, falling back to
+    PyPDF2 when PyMuPDF is unavailable or can't parse the file. Large PDFs
+    are extracted in page batches on a thread pool; batches past the limit
+    are cancelled.
+    """
+    try:
+        import fitz
+        
+        with fitz.open(stream=content, filetype="pdf") as doc:
+            page_count = doc.page_count
+            if page_count < PDF_PARALLEL_MIN_PAGES or PDF_MAX_WORKERS == 1:
+                return _join_until((page.get_text("text") for page in doc), max_chars)
+        
+        executor = ThreadPoolExecutor(max_workers=PDF_MAX_WORKERS)
+        try:
+            futures = [
+                executor.submit(_extract_pdf_pages, content, start, min(start + PDF_PAGE_BATCH, page_count))
+                for start in range(0, page_count, PDF_PAGE_BATCH)
+            ]
+            return _join_until((future.result() for future in futures), max_chars)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    except (ImportError, RuntimeError) as e:
+        # fitz.FileDataError subclasses RuntimeError
+        logger.warning("PyMuPDF extraction failed, falling back to PyPDF2", error=str(e))
+    
+    import io
+    import PyPDF2
+    
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
+    return _join_until((page.extract_text() or "" for page in pdf_reader.pages), max_chars)
+
+
+# CSVs smaller than this are summarised without pandas
+SMALL_CSV_BYTES = 256 * 1024
+
+
+def _small_csv_text(content: bytes) -> str:
+    """
+    Same summary as the DataFrame path for a small CSV, built from the raw
+    lines. Row counts are line counts, so quoted fields with embedded
+    newlines count more than once.
+    """
+    import csv
+    
+    lines = content.decode("utf-8", errors="ignore").splitlines()
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if not lines:
+        return "Spreadsheet Data:\nColumns: \nRows: 0\n\n"
+    
+    columns = next(csv.reader(lines[:1]))
+    extracted_text = f"Spreadsheet Data:\n"
+    extracted_text += f"Columns: {', '.join(columns)}\n"
+    extracted_text += f"Rows: {len(lines) - 1}\n\n"
+    extracted_text += "\n".join(lines[:101]) + "\n"  # Header plus the first 100 rows
+    return extracted_text
+
+
+def _read_spreadsheet(content: bytes, mime_type: str):
+    """
+    Load a CSV or Excel file into a DataFrame using the PyArrow CSV parser
+    and the calamine Excel reader, falling back to pandas' default engines
+    when those aren't installed.
+    """
+    import io
+    import pandas as pd
+    
+    if mime_type == "text/csv":
+        try:
+            return pd.read_csv(io.BytesIO(content), engine="pyarrow", dtype_backend="pyarrow")
+        except ImportError:
+            return pd.read_csv(io.BytesIO(content))
+    
+    try:
+        return pd.read_excel(io.BytesIO(content), engine="calamine")
+    except (ImportError, ValueError):
+        # ValueError: pandas older than 2.2 doesn't know the calamine engine
+        return pd.read_excel(io.BytesIO(content))
+
+
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+
+
+@lru_cache(maxsize=None)
+def _get_ocr_engine():
+    """
+    RapidOCR engine, loaded once per process on first use. Returns None when
+    rapidocr-onnxruntime isn't installed.
+    """
+    try:
+        from rapidocr_onnxruntime import RapidOCR
+    except ImportError:
+        return None
+    return RapidOCR()
+
+
+def _ocr_image(image) -> str:
+    """
+    OCR a PIL image in-process with RapidOCR, falling back to the tesseract
+    binary via pytesseract.
+    """
+    engine = _get_ocr_engine()
+    if engine is None:
+        import pytesseract
+        
+        # Grayscale input, LSTM engine only and a single uniform text block
+        # instead of full automatic page segmentation
+        return pytesseract.image_to_string(image.convert("L"), lang="eng", config=TESSERACT_CONFIG)
+    
+    import numpy as np
+    
+    result, _ = engine(np.asarray(image.convert("RGB")))
+    return "\n".join(line[1] for line in result or ())
+
+
+# Passage size for retrieval, roughly 512 tokens with 25% overlap
+CHUNK_SIZE = 2048
+CHUNK_OVERLAP = 512
+# One batch embedding request holds at most 100 passages
+MAX_CHUNKS = 100
+# Text past this point can never land in the first MAX_CHUNKS chunks, so
+# extraction stops there
+MAX_TEXT_CHARS = MAX_CHUNKS * CHUNK_SIZE
+
+# Must match knowledge_documents.embedding (vector(768)); gemini-embedding-001
+# returns 3072 dimensions unless told otherwise
+EMBEDDING_MODEL = "gemini-embedding-001"
+EMBEDDING_DIM = 768
+_CHUNK_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def _chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """
+    Split text into overlapping chunks, breaking at the coarsest natural
+    boundary (paragraph, line, sentence, word) in the back half of each window.
+    """
+    chunks = []
+    start = 0
+    length = len(text)
+    
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            for separator in _CHUNK_SEPARATORS:
+                cut = text.rfind(separator, start + chunk_size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        
+        if end >= length:
+            break
+        start = max(end - overlap, start + 1)
+    
+    return chunks
+
+
+def embed_query(query: str) -> list[float] | None:
+    """
+    Embed a search query for match_knowledge_documents. Returns None if the
+    embedding request fails so callers can fall back to a text search.
+    """
+    try:
+        import google.generativeai as genai_embed
+        
+        genai_embed.configure(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
+        result = genai_embed.embed_content(
+            model=EMBEDDING_MODEL,
+            content=query,
+            task_type="retrieval_query",
+            output_dimensionality=EMBEDDING_DIM
+        )
+        embedding = result["embedding"]
+        if len(embedding) != EMBEDDING_DIM:
+            raise ValueError(f"expected a {EMBEDDING_DIM}-dim embedding, got {len(embedding)}")
+        return embedding
+    except Exception as e:
+        logger.warning("Failed to embed search query", error=str(e))
+        return None
+
+
+def process_document_content(file_id: str, content: bytes, org_id: str):
+    """
+    Extract text from an uploaded document, embed it and store it as a
+    knowledge document.
+    """
+    try:
+        import io
+        import docx
+        from PIL import Image
+        import google.generativeai as genai_embed
+        
+        # Configure Gemini for embeddings
+        genai_embed.configure(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
+        
+        extracted_text = ""
+        file_info = get_supabase().table("file_uploads").select("*").eq("id", file_id).execute()
+        if not file_info.data:
+            raise Exception("File not found")
+        
+        file_data = file_info.data[0]
+        filename = file_data["filename"]
+        mime_type = file_data["mime_type"]
+        
+        # Extract text based on file type
+        if mime_type == "application/pdf":
+            # PDF processing
+            extracted_text = _extract_pdf_text(content, MAX_TEXT_CHARS)
+                
+        elif mime_type in ["application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]:
+            # Word document processing
+            if mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+                doc_file = io.BytesIO(content)
+                doc = docx.Document(doc_file)
+                extracted_text = _join_until((paragraph.text for paragraph in doc.paragraphs), MAX_TEXT_CHARS)
+            else:
+                # .doc files need special handling (for production, use python-docx2txt)
+                extracted_text = "DOC file processing requires additional setup. Please use DOCX format."
+                
+        elif mime_type in ["application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "text/csv"]:
+            # Excel/CSV processing
+            try:
+                if mime_type == "text/csv" and len(content) < SMALL_CSV_BYTES:
+                    extracted_text = _small_csv_text(content)
+                else:
+                    df = _read_spreadsheet(content, mime_type)
+                    
+                    # Convert dataframe to text representation
+                    extracted_text = f"Spreadsheet Data:\n"
+                    extracted_text += f"Columns: {', '.join(map(str, df.columns))}\n"
+                    extracted_text += f"Rows: {len(df)}\n\n"
+                    extracted_text += df.head(100).to_csv(index=False)  # Limit to first 100 rows
+            except Exception as e:
+                extracted_text = f"Error processing spreadsheet: {str(e)}"
+                
+        elif mime_type.startswith("image/"):
+            # Image OCR processing
+            try:
+                image = Image.open(io.BytesIO(content))
+                extracted_text = _ocr_image(image)
+                if not extracted_text.strip():
+                    extracted_text = "No text found in image"
+            except Exception as e:
+                extracted_text = f"Error processing image: {str(e)}"
+                
+        elif mime_type.startswith("video/") or mime_type.startswith("audio/"):
+            # Video/Audio processing (placeholder - requires additional setup)
+            extracted_text = f"Video/Audio file uploaded: {filename}. Transcript extraction requires additional setup with speech-to-text services."
+            
+        elif mime_type in ["text/plain", "text/markdown"]:
+            # Text file processing (a UTF-8 character is at most 4 bytes)
+            head = content[:MAX_TEXT_CHARS * 4]
+            try:
+                extracted_text = head.decode('utf-8')[:MAX_TEXT_CHARS]
+            except UnicodeDecodeError:
+                extracted_text = head.decode('utf-8', errors='ignore')[:MAX_TEXT_CHARS]
+        else:
+            extracted_text = f"Unsupported file type: {mime_type}"
+        
+        # Split into overlapping passages for passage-level retrieval
+        chunks = _chunk_text(extracted_text)
+        if len(chunks) > MAX_CHUNKS:
+            logger.warning("Document truncated to chunk limit",
+                           file_id=file_id, chunk_count=len(chunks), max_chunks=MAX_CHUNKS)
+            chunks = chunks[:MAX_CHUNKS]
+        
+        # Generate embeddings for all chunks in one batch request
+        embeddings = [None] * len(chunks)
+        try:
+            if chunks:
+                embedding_result = genai_embed.embed_content(
+                    model=EMBEDDING_MODEL,
+                    content=chunks,
+                    task_type="retrieval_document",
+                    output_dimensionality=EMBEDDING_DIM
+                )
+                embeddings = embedding_result["embedding"]
+                if any(len(embedding) != EMBEDDING_DIM for embedding in embeddings):
+                    raise ValueError(f"expected {EMBEDDING_DIM}-dim embeddings, got {len(embeddings[0])}")
+                logger.info("Generated embeddings for document", file_id=file_id,
+                            chunk_count=len(chunks), embedding_dim=len(embeddings[0]))
+        except Exception as e:
+            # Store the text without embeddings rather than losing the upload
+            embeddings = [None] * len(chunks)
+            logger.warning("Failed to generate embeddings", error=str(e), file_id=file_id)
+        
+        # Update file as processed
+        get_supabase().table("file_uploads").update({"is_processed": True}).eq("id", file_id).execute()
+        
+        # Create one knowledge document per chunk
+        processing_date = iso_now()
+        knowledge_docs = [
+            {
+                "title": file_data["original_name"],  # Use original filename as title
+                "content": chunk,
+                "source_type": "upload",
+                "source_id": file_id,
+                "org_id": org_id,
+                "embedding": embedding,
+                "metadata": {
+                    "processing_date": processing_date,
+                    "content_length": len(chunk),
+                    "chunk_index": index,
+                    "chunk_count": len(chunks),
+                    "mime_type": mime_type,
+                    "original_filename": file_data["original_name"],
+                    "file_size": file_data["size_bytes"]
+                }
+            }
+            for index, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+        ]
+        
+        if knowledge_docs:
+            get_supabase().table("knowledge_documents").insert(knowledge_docs).execute()
+        
+        logger.info("Document processed successfully", 
+                   file_id=file_id, 
+                   text_length=len(extracted_text),
+                   chunk_count=len(chunks),
+                   has_embedding=embeddings[0] is not None if embeddings else False)
+        
+    except Exception as e:
+        logger.error("Failed to process document", error=str(e), file_id=file_id)
+        # Mark as processed even if failed to avoid retry loops
+        try:
+            get_supabase().table("file_uploads").update({
+                "is_processed": True,
+                "processing_error": str(e)
+            }).eq("id", file_id).execute()
+        except:
+            pass
+
+
+def process_document(file_id: str, file_path: str, org_id: str):
+    """
+    Background task to process an upload spooled to file_path.
+    Deletes the file when done.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            content = f.read()
+        process_document_content(file_id, content, org_id)
+    finally:
+        try:
+            os.unlink(file_path)
+        except OSError:
+            pass
+
+
+def download_upload(file_id: str) -> bytes:
+    """Fetch an uploaded file's bytes back from Supabase Storage."""
+    file_info = get_supabase().table("file_uploads").select("filename").eq("id", file_id).execute()
+    if not file_info.data:
+        raise Exception("File not found")
+    return get_supabase().storage.from_("knowledge-documents").download(file_info.data[0]["filename"])
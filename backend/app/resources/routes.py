@@ -3,13 +3,19 @@ Resource management routes for K-Orbit API.
 Handles file uploads, document processing, and knowledge base management.
 """
 
+import asyncio
+import base64
+import hashlib
 import os
+import tempfile
 import uuid
-from datetime import datetime
+from types import MappingProxyType
 from typing import List, Optional
+import aiofiles
+import httpx
 import structlog
-from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, Query, BackgroundTasks
-from supabase import create_client, Client
+from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, Query, BackgroundTasks, Response
+from pydantic import TypeAdapter
 
 from app.auth.middleware import get_current_user, require_sme, require_manager
 from app.resources.models import (
@@ -21,18 +27,18 @@ from app.resources.models import (
     DocumentSearchRequest,
     DocumentSearchResponse
 )
+from app.resources.processing import embed_query, get_supabase, iso_now, process_document
+from app.resources.tasks import CELERY_BROKER_URL, process_document_task
 
 logger = structlog.get_logger()
 
-# Initialize Supabase client
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_ANON_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
 
 router = APIRouter()
 
-# Allowed file types and size limits
-ALLOWED_FILE_TYPES = {
+# Allowed file types and size limits (read-only)
+ALLOWED_FILE_TYPES = MappingProxyType({
     # Documents
     "application/pdf": ".pdf",
     "application/msword": ".doc",
@@ -62,8 +68,122 @@ ALLOWED_FILE_TYPES = {
     "audio/mp3": ".mp3",
     "audio/wav": ".wav",
     "audio/m4a": ".m4a"
-}
+})
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB (increased for videos)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Uploads are copied to disk 1MB at a time
+# Files above this go through Storage's resumable (TUS) endpoint, which
+# requires 6MB chunks
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+TUS_MAX_RETRIES = 3
+
+# Serializer for list responses. The list endpoints return pre-rendered JSON so
+# FastAPI doesn't re-validate every item and run it through json.dumps again;
+# response_model is kept for the OpenAPI schema.
+_upload_list_adapter = TypeAdapter(List[FileUploadResponse])
+
+
+def _public_url(filename: str) -> str:
+    """Public URL of an object in the knowledge-documents bucket (no API call needed)."""
+    return f"{supabase_url}/storage/v1/object/public/knowledge-documents/{filename}"
+
+
+def _file_upload_response(row: dict) -> FileUploadResponse:
+    return FileUploadResponse(
+        id=row["id"],
+        filename=row["filename"],
+        original_name=row["original_name"],
+        mime_type=row["mime_type"],
+        size_bytes=row["size_bytes"],
+        url=row["url"],
+        is_processed=row["is_processed"],
+        uploaded_at=row["created_at"]
+    )
+
+
+async def _spool_upload(file: UploadFile, suffix: str) -> tuple[str, int, str]:
+    """
+    Copy an upload to a temporary file in fixed-size chunks, rejecting it as
+    soon as it passes MAX_FILE_SIZE. Returns the file path, size in bytes and
+    SHA-256 hex digest of the content.
+    """
+    total = 0
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        # Disk writes go through aiofiles' thread pool so they don't block the loop
+        async with aiofiles.open(path, "wb") as tmp:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File size exceeds maximum limit of {MAX_FILE_SIZE // (1024*1024)}MB"
+                    )
+                digest.update(chunk)
+                await tmp.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    
+    return path, total, digest.hexdigest()
+
+
+async def _tus_upload(path: str, size: int, object_name: str, content_type: str):
+    """
+    Upload a spooled file to the knowledge-documents bucket with the TUS
+    resumable protocol, sending TUS_CHUNK_SIZE chunks. A failed chunk is
+    resumed from the offset the server reports.
+    """
+    def b64(value: str) -> str:
+        return base64.b64encode(value.encode()).decode()
+    
+    headers = {
+        "Authorization": f"Bearer {supabase_key}",
+        "apikey": supabase_key,
+        "Tus-Resumable": "1.0.0",
+    }
+    async with httpx.AsyncClient(timeout=60) as client:
+        created = await client.post(
+            f"{supabase_url}/storage/v1/upload/resumable",
+            headers={
+                **headers,
+                "Upload-Length": str(size),
+                "Upload-Metadata": (
+                    f"bucketName {b64('knowledge-documents')},"
+                    f"objectName {b64(object_name)},"
+                    f"contentType {b64(content_type)}"
+                ),
+            },
+        )
+        created.raise_for_status()
+        upload_url = created.headers["Location"]
+        
+        offset = 0
+        retries = 0
+        async with aiofiles.open(path, "rb") as f:
+            while offset < size:
+                await f.seek(offset)
+                chunk = await f.read(TUS_CHUNK_SIZE)
+                try:
+                    response = await client.patch(
+                        upload_url,
+                        content=chunk,
+                        headers={
+                            **headers,
+                            "Upload-Offset": str(offset),
+                            "Content-Type": "application/offset+octet-stream",
+                        },
+                    )
+                    response.raise_for_status()
+                    offset = int(response.headers["Upload-Offset"])
+                except httpx.HTTPError:
+                    retries += 1
+                    if retries > TUS_MAX_RETRIES:
+                        raise
+                    head = await client.head(upload_url, headers=headers)
+                    head.raise_for_status()
+                    offset = int(head.headers["Upload-Offset"])
 
 
 @router.post("/upload", response_model=FileUploadResponse)
@@ -75,6 +195,7 @@ async def upload_file(
     """
     Upload a file to the knowledge base (SME and managers only).
     """
+    tmp_path = None
     try:
         # Validate file type
         if file.content_type not in ALLOWED_FILE_TYPES:
@@ -83,38 +204,57 @@ async def upload_file(
                 detail=f"File type {file.content_type} not supported"
             )
         
-        # Validate file size
-        file_content = await file.read()
-        if len(file_content) > MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File size exceeds maximum limit of {MAX_FILE_SIZE // (1024*1024)}MB"
+        # Oversized requests with a Content-Length were already rejected by
+        # UploadSizeLimitMiddleware. Copy to disk in chunks, validating size as we go
+        file_extension = ALLOWED_FILE_TYPES[file.content_type]
+        tmp_path, file_size, content_hash = await _spool_upload(file, file_extension)
+        
+        # Identical content already uploaded in this org: reuse that row
+        # instead of storing and processing the file again
+        existing = await asyncio.to_thread(
+            get_supabase().table("file_uploads").select("*").eq(
+                "org_id", user["org_id"]
+            ).eq("content_hash", content_hash).limit(1).execute
+        )
+        if existing.data:
+            logger.info(
+                "Duplicate upload reused",
+                file_id=existing.data[0]["id"],
+                filename=file.filename,
+                user_id=user["sub"]
             )
+            return _file_upload_response(existing.data[0])
         
         # Generate unique filename
-        file_extension = ALLOWED_FILE_TYPES[file.content_type]
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         
-        # Upload to Supabase Storage
-        storage_response = supabase.storage.from_("knowledge-documents").upload(
-            unique_filename, 
-            file_content,
-            {"content-type": file.content_type}
-        )
-        
-        if storage_response.get("error"):
-            raise HTTPException(status_code=500, detail="Failed to upload file to storage")
-        
-        # Get public URL
-        public_url = supabase.storage.from_("knowledge-documents").get_public_url(unique_filename)
+        # Upload to Supabase Storage from the temp file; large files go in
+        # resumable chunks
+        if file_size > TUS_CHUNK_SIZE:
+            try:
+                await _tus_upload(tmp_path, file_size, unique_filename, file.content_type)
+            except httpx.HTTPError as e:
+                logger.error("Resumable upload failed", error=str(e), filename=unique_filename)
+                raise HTTPException(status_code=500, detail="Failed to upload file to storage")
+        else:
+            storage_response = await asyncio.to_thread(
+                get_supabase().storage.from_("knowledge-documents").upload,
+                unique_filename, 
+                tmp_path,
+                {"content-type": file.content_type}
+            )
+            
+            if isinstance(storage_response, dict) and storage_response.get("error"):
+                raise HTTPException(status_code=500, detail="Failed to upload file to storage")
         
         # Save file metadata to database
         file_data = {
             "filename": unique_filename,
             "original_name": file.filename,
             "mime_type": file.content_type,
-            "size_bytes": len(file_content),
-            "url": public_url.get("publicURL", ""),
+            "size_bytes": file_size,
+            "content_hash": content_hash,
+            "url": _public_url(unique_filename),
             "uploaded_by": user["sub"],
             "org_id": user["org_id"],
             "is_processed": False,
@@ -124,11 +264,19 @@ async def upload_file(
             }
         }
         
-        file_response = supabase.table("file_uploads").insert(file_data).execute()
+        file_response = await asyncio.to_thread(
+            get_supabase().table("file_uploads").insert(file_data).execute
+        )
         uploaded_file = file_response.data[0]
         
-        # Schedule background processing
-        background_tasks.add_task(process_document, uploaded_file["id"], file_content, user["org_id"])
+        # Schedule processing: on the Celery worker queue when a broker is
+        # configured (the worker re-downloads the file from storage),
+        # otherwise as a background task that takes over the temp file
+        if CELERY_BROKER_URL:
+            process_document_task.delay(uploaded_file["id"], user["org_id"])
+        else:
+            background_tasks.add_task(process_document, uploaded_file["id"], tmp_path, user["org_id"])
+            tmp_path = None
         
         logger.info(
             "File uploaded successfully",
@@ -137,162 +285,16 @@ async def upload_file(
             user_id=user["sub"]
         )
         
-        return FileUploadResponse(
-            id=uploaded_file["id"],
-            filename=uploaded_file["filename"],
-            original_name=uploaded_file["original_name"],
-            mime_type=uploaded_file["mime_type"],
-            size_bytes=uploaded_file["size_bytes"],
-            url=uploaded_file["url"],
-            is_processed=uploaded_file["is_processed"],
-            uploaded_at=uploaded_file["created_at"]
-        )
+        return _file_upload_response(uploaded_file)
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error("Failed to upload file", error=str(e), filename=file.filename)
         raise HTTPException(status_code=500, detail="Failed to upload file")
-
-
-async def process_document(file_id: str, content: bytes, org_id: str):
-    """
-    Background task to process uploaded document and extract content.
-    """
-    try:
-        import io
-        import PyPDF2
-        import docx
-        import pandas as pd
-        from PIL import Image
-        import pytesseract
-        import google.generativeai as genai_embed
-        
-        # Configure Gemini for embeddings
-        genai_embed.configure(api_key=os.getenv("GOOGLE_GEMINI_API_KEY"))
-        
-        extracted_text = ""
-        file_info = supabase.table("file_uploads").select("*").eq("id", file_id).execute()
-        if not file_info.data:
-            raise Exception("File not found")
-        
-        file_data = file_info.data[0]
-        filename = file_data["filename"]
-        mime_type = file_data["mime_type"]
-        
-        # Extract text based on file type
-        if mime_type == "application/pdf":
-            # PDF processing
-            pdf_file = io.BytesIO(content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            for page in pdf_reader.pages:
-                extracted_text += page.extract_text() + "\n"
-                
-        elif mime_type in ["application/msword", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]:
-            # Word document processing
-            if mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                doc_file = io.BytesIO(content)
-                doc = docx.Document(doc_file)
-                for paragraph in doc.paragraphs:
-                    extracted_text += paragraph.text + "\n"
-            else:
-                # .doc files need special handling (for production, use python-docx2txt)
-                extracted_text = "DOC file processing requires additional setup. Please use DOCX format."
-                
-        elif mime_type in ["application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "text/csv"]:
-            # Excel/CSV processing
-            try:
-                if mime_type == "text/csv":
-                    df = pd.read_csv(io.BytesIO(content))
-                else:
-                    df = pd.read_excel(io.BytesIO(content))
-                
-                # Convert dataframe to text representation
-                extracted_text = f"Spreadsheet Data:\n"
-                extracted_text += f"Columns: {', '.join(df.columns.tolist())}\n"
-                extracted_text += f"Rows: {len(df)}\n\n"
-                extracted_text += df.to_string(max_rows=100)  # Limit to first 100 rows
-            except Exception as e:
-                extracted_text = f"Error processing spreadsheet: {str(e)}"
-                
-        elif mime_type.startswith("image/"):
-            # Image OCR processing
-            try:
-                image = Image.open(io.BytesIO(content))
-                extracted_text = pytesseract.image_to_string(image)
-                if not extracted_text.strip():
-                    extracted_text = "No text found in image"
-            except Exception as e:
-                extracted_text = f"Error processing image: {str(e)}"
-                
-        elif mime_type.startswith("video/") or mime_type.startswith("audio/"):
-            # Video/Audio processing (placeholder - requires additional setup)
-            extracted_text = f"Video/Audio file uploaded: {filename}. Transcript extraction requires additional setup with speech-to-text services."
-            
-        elif mime_type in ["text/plain", "text/markdown"]:
-            # Text file processing
-            try:
-                extracted_text = content.decode('utf-8')
-            except UnicodeDecodeError:
-                extracted_text = content.decode('utf-8', errors='ignore')
-        else:
-            extracted_text = f"Unsupported file type: {mime_type}"
-        
-        # Limit content length
-        if len(extracted_text) > 10000:
-            extracted_text = extracted_text[:10000] + "... (content truncated)"
-        
-        # Generate embeddings using Google Gemini
-        embedding_vector = None
-        try:
-            if extracted_text.strip():
-                embedding_result = genai_embed.embed_content(
-                    model="gemini-embedding-001",
-                    content=extracted_text,
-                    task_type="retrieval_document"
-                )
-                embedding_vector = embedding_result["embedding"]["values"]
-                logger.info("Generated embedding for document", file_id=file_id, embedding_dim=len(embedding_vector))
-        except Exception as e:
-            logger.warning("Failed to generate embedding", error=str(e), file_id=file_id)
-        
-        # Update file as processed
-        supabase.table("file_uploads").update({"is_processed": True}).eq("id", file_id).execute()
-        
-        # Create knowledge document with embedding
-        knowledge_doc = {
-            "title": file_data["original_name"],  # Use original filename as title
-            "content": extracted_text,
-            "source_type": "upload",
-            "source_id": file_id,
-            "org_id": org_id,
-            "embedding": embedding_vector,  # Store the actual embedding
-            "metadata": {
-                "processing_date": datetime.utcnow().isoformat(),
-                "content_length": len(extracted_text),
-                "mime_type": mime_type,
-                "original_filename": file_data["original_name"],
-                "file_size": file_data["size_bytes"]
-            }
-        }
-        
-        supabase.table("knowledge_documents").insert(knowledge_doc).execute()
-        
-        logger.info("Document processed successfully", 
-                   file_id=file_id, 
-                   text_length=len(extracted_text),
-                   has_embedding=embedding_vector is not None)
-        
-    except Exception as e:
-        logger.error("Failed to process document", error=str(e), file_id=file_id)
-        # Mark as processed even if failed to avoid retry loops
-        try:
-            supabase.table("file_uploads").update({
-                "is_processed": True,
-                "processing_error": str(e)
-            }).eq("id", file_id).execute()
-        except:
-            pass
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
 
 
 @router.get("/uploads", response_model=List[FileUploadResponse])
@@ -308,7 +310,7 @@ async def list_uploads(
         offset = (page - 1) * limit
         
         # Build query based on user role
-        query = supabase.table("file_uploads").select("*")
+        query = get_supabase().table("file_uploads").select("*")
         
         if user.get("role") == "manager":
             # Managers can see all org files
@@ -322,9 +324,9 @@ async def list_uploads(
         
         response = query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
         
-        uploads = []
-        for upload in response.data:
-            uploads.append(FileUploadResponse(
+        # Rows come from our own table, so skip validation
+        uploads = [
+            FileUploadResponse.model_construct(
                 id=upload["id"],
                 filename=upload["filename"],
                 original_name=upload["original_name"],
@@ -333,9 +335,11 @@ async def list_uploads(
                 url=upload["url"],
                 is_processed=upload["is_processed"],
                 uploaded_at=upload["created_at"]
-            ))
+            )
+            for upload in response.data
+        ]
         
-        return uploads
+        return Response(content=_upload_list_adapter.dump_json(uploads, warnings=False), media_type="application/json")
         
     except Exception as e:
         logger.error("Failed to list uploads", error=str(e))
@@ -355,25 +359,50 @@ async def search_knowledge_documents(
     """
     try:
         offset = (page - 1) * limit
-        
-        # Build search query
-        db_query = supabase.table("knowledge_documents").select("*").eq("org_id", user["org_id"])
-        
-        if source_type:
-            db_query = db_query.eq("source_type", source_type)
+        rows = None
+        total_count = None
         
         if query:
-            # Simple text search (in production, use vector similarity)
-            db_query = db_query.ilike("content", f"%{query}%")
-        
-        response = db_query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+            # Hybrid vector + full-text ranking; ilike below is the fallback
+            query_embedding = await asyncio.to_thread(embed_query, query)
+            if query_embedding is not None:
+                try:
+                    response = await asyncio.to_thread(
+                        get_supabase().rpc("match_knowledge_documents", {
+                            "org": user["org_id"],
+                            "query_embedding": query_embedding,
+                            "query_text": query,
+                            "k": offset + limit,
+                            "filter_source_type": source_type
+                        }).execute
+                    )
+                    rows = response.data[offset:offset + limit]
+                    # Every row carries the number of documents the search can rank
+                    total_count = response.data[0]["total_count"] if response.data else 0
+                except Exception as e:
+                    logger.warning("Hybrid knowledge search failed, falling back to text match", error=str(e))
+        
+        if rows is None:
+            # Build search query
+            db_query = get_supabase().table("knowledge_documents").select("*", count="exact").eq("org_id", user["org_id"])
+            
+            if source_type:
+                db_query = db_query.eq("source_type", source_type)
+            
+            if query:
+                db_query = db_query.ilike("content", f"%{query}%")
+            
+            response = db_query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+            rows = response.data
+            total_count = response.count or 0
         
         documents = []
-        for doc in response.data:
-            documents.append(KnowledgeDocumentResponse(
+        for doc in rows:
+            content = doc["content"]
+            documents.append(KnowledgeDocumentResponse.model_construct(
                 id=doc["id"],
                 title=doc["title"],
-                content=doc["content"][:500] + "..." if len(doc["content"]) > 500 else doc["content"],
+                content=content[:500] + "..." if len(content) > 500 else content,
                 source_type=doc["source_type"],
                 source_id=doc.get("source_id"),
                 metadata=doc.get("metadata", {}),
@@ -381,13 +410,15 @@ async def search_knowledge_documents(
                 updated_at=doc["updated_at"]
             ))
         
-        return DocumentSearchResponse(
+        result = DocumentSearchResponse.model_construct(
             documents=documents,
-            total_count=len(response.data),
+            total_count=total_count,
             page=page,
             limit=limit,
-            has_more=len(response.data) == limit
+            has_more=offset + limit < total_count
         )
+        # Timestamps are the ISO strings from the database; skip the datetime type warnings
+        return Response(content=result.model_dump_json(warnings=False), media_type="application/json")
         
     except Exception as e:
         logger.error("Failed to search knowledge documents", error=str(e))
@@ -416,7 +447,7 @@ async def create_knowledge_document(
             }
         }
         
-        response = supabase.table("knowledge_documents").insert(doc_data).execute()
+        response = get_supabase().table("knowledge_documents").insert(doc_data).execute()
         doc = response.data[0]
         
         return KnowledgeDocumentResponse(
@@ -445,28 +476,23 @@ async def update_knowledge_document(
     Update a knowledge document (SME and managers only).
     """
     try:
-        # Check if document exists and user has permission
-        existing_doc = supabase.table("knowledge_documents").select("*").eq(
-            "id", document_id
-        ).eq("org_id", user["org_id"]).execute()
-        
-        if not existing_doc.data:
-            raise HTTPException(status_code=404, detail="Document not found")
-        
-        # Update document
-        update_data = {
-            "title": request.title,
-            "content": request.content,
-            "metadata": {
-                **existing_doc.data[0].get("metadata", {}),
+        # Update and merge metadata server-side; no row back means the
+        # document doesn't exist or belongs to another org
+        response = get_supabase().rpc("update_knowledge_document_merge", {
+            "doc_id": document_id,
+            "org": user["org_id"],
+            "new_title": request.title,
+            "new_content": request.content,
+            "metadata_patch": {
                 "updated_by": user["sub"],
-                "last_modified": datetime.utcnow().isoformat(),
+                "last_modified": iso_now(),
                 **request.metadata
-            },
-            "updated_at": datetime.utcnow().isoformat()
-        }
+            }
+        }).execute()
+        
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Document not found")
         
-        response = supabase.table("knowledge_documents").update(update_data).eq("id", document_id).execute()
         doc = response.data[0]
         
         return KnowledgeDocumentResponse(
@@ -496,17 +522,14 @@ async def delete_knowledge_document(
     Delete a knowledge document (SME and managers only).
     """
     try:
-        # Check if document exists and user has permission
-        existing_doc = supabase.table("knowledge_documents").select("*").eq(
+        # Delete within the user's org; no row back means nothing matched
+        response = get_supabase().table("knowledge_documents").delete().eq(
             "id", document_id
         ).eq("org_id", user["org_id"]).execute()
         
-        if not existing_doc.data:
+        if not response.data:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        # Delete document
-        supabase.table("knowledge_documents").delete().eq("id", document_id).execute()
-        
         logger.info("Knowledge document deleted", document_id=document_id, user_id=user["sub"])
         
         return {"message": "Document deleted successfully"}
@@ -526,5 +549,5 @@ async def resources_health():
     return {
         "status": "healthy",
         "service": "resources",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": iso_now()
     } 
\ No newline at end of file
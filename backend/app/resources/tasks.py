@@ -0,0 +1,28 @@
+"""
+Celery tasks for K-Orbit resources.
+Document processing runs in dedicated worker processes so CPU-heavy parsing
+and OCR don't compete with the API for the event loop.
+
+Run workers with:
+    celery -A app.resources.tasks worker -Q document-processing --concurrency=N
+"""
+
+import os
+from celery import Celery
+
+from app.resources.processing import download_upload, process_document_content
+
+# Document processing is queued only when a broker is configured; otherwise
+# uploads fall back to in-process background tasks
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL") or os.getenv("REDIS_URL")
+
+celery_app = Celery("korbit", broker=CELERY_BROKER_URL)
+celery_app.conf.task_routes = {"process_document": {"queue": "document-processing"}}
+celery_app.conf.worker_prefetch_multiplier = 1
+
+
+@celery_app.task(name="process_document", acks_late=True)
+def process_document_task(file_id: str, org_id: str):
+    """Download an upload from storage and process it."""
+    content = download_upload(file_id)
+    process_document_content(file_id, content, org_id)
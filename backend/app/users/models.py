@@ -4,7 +4,7 @@ Pydantic models for user management.
 
 from datetime import datetime
 from typing import Optional, List
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, validator
 
 
 class UserListResponse(BaseModel):
@@ -18,6 +18,11 @@ class UserListResponse(BaseModel):
     avatar_url: Optional[str] = Field(None, description="User avatar URL")
     last_active: Optional[datetime] = Field(None, description="Last activity timestamp")
     onboarding_completed: bool = Field(..., description="Onboarding completion status")
+    
+    @validator("onboarding_completed", pre=True)
+    def default_onboarding_completed(cls, v):
+        # The profiles column is nullable
+        return bool(v)
 
 
 class UserDetailResponse(BaseModel):
@@ -70,6 +75,7 @@ class UserSearchResponse(BaseModel):
     page: int = Field(..., description="Current page")
     limit: int = Field(..., description="Items per page")
     pages: int = Field(..., description="Total number of pages")
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page, if there is one")
 
 
 class UserActivityLog(BaseModel):
@@ -102,4 +108,8 @@ class UserStatsResponse(BaseModel):
 
 # Update forward references
 UserDetailResponse.model_rebuild()
-UserListResponse.model_rebuild() 
\ No newline at end of file
+UserListResponse.model_rebuild()
+
+# Validate database rows into response lists in one compiled pass
+USER_LIST_ADAPTER = TypeAdapter(List[UserListResponse])
+USER_ACTIVITY_ADAPTER = TypeAdapter(List[UserActivityLog])
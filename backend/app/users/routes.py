@@ -3,15 +3,22 @@ User management routes for K-Orbit API.
 Handles user CRUD operations, search, and statistics.
 """
 
+import asyncio
 import os
 import math
-from datetime import datetime
+import base64
+import json
+import re
+from datetime import datetime, timedelta
 from typing import List, Optional
+from uuid import UUID
 import structlog
 from fastapi import APIRouter, HTTPException, Request, Depends, Query
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
 
 from app.auth.middleware import get_current_user, require_manager, require_admin
+from app.database import get_db_manager, get_query_cache, user_stats_tag
 from app.users.models import (
     UserDetailResponse,
     UserListResponse,
@@ -19,7 +26,9 @@ from app.users.models import (
     UserSearchRequest,
     UserSearchResponse,
     UserStatsResponse,
-    UserActivityLog
+    UserActivityLog,
+    USER_LIST_ADAPTER,
+    USER_ACTIVITY_ADAPTER
 )
 
 logger = structlog.get_logger()
@@ -31,6 +40,65 @@ supabase: Client = create_client(supabase_url, supabase_key)
 
 router = APIRouter()
 
+# Statistics are invalidated on XP/badge/enrollment/forum writes; the TTL
+# bounds staleness for changes made elsewhere (DB triggers, other workers)
+USER_STATS_TTL = 300
+
+# Profile projections: exactly the columns UserDetailResponse and
+# UserListResponse read, so search_vector and future wide columns stay in the DB
+PROFILE_COLS = (
+    "id, email, full_name, role, org_id, department, position, avatar_url, "
+    "manager_id, onboarding_completed, last_active, created_at, updated_at"
+)
+PROFILE_LIST_COLS = (
+    "id, email, full_name, role, department, position, avatar_url, "
+    "last_active, onboarding_completed"
+)
+
+
+def _encode_cursor(row: dict) -> str:
+    """Opaque keyset cursor for the (last_active, id) of the last row on a page."""
+    return base64.urlsafe_b64encode(json.dumps([row.get("last_active"), row["id"]]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    """
+    Decode and normalise a keyset cursor. Both values end up in a PostgREST
+    filter string, so anything that isn't a timestamp (or null) and a UUID
+    is rejected rather than passed through.
+    """
+    try:
+        last_active, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(user_id, str) or not (last_active is None or isinstance(last_active, str)):
+            raise ValueError("cursor values must be strings")
+        user_id = str(UUID(user_id))
+        if last_active is not None:
+            last_active = datetime.fromisoformat(last_active).isoformat()
+        return last_active, user_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _apply_profile_filters(builder, role, department, manager_id, include_inactive):
+    """Apply the search_users filters to a profiles query or RPC builder."""
+    builder = builder.is_("deleted_at", "null")
+    
+    if role:
+        builder = builder.eq("role", role)
+    
+    if department:
+        builder = builder.eq("department", department)
+        
+    if manager_id:
+        builder = builder.eq("manager_id", manager_id)
+    
+    # Handle inactive users (last_active > 30 days ago)
+    if not include_inactive:
+        thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
+        builder = builder.gte("last_active", thirty_days_ago)
+    
+    return builder
+
 
 @router.get("/search", response_model=UserSearchResponse)
 async def search_users(
@@ -41,64 +109,73 @@ async def search_users(
     include_inactive: bool = Query(False, description="Include inactive users"),
     page: int = Query(1, ge=1, description="Page number"),
     limit: int = Query(20, ge=1, le=100, description="Items per page"),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor; replaces page, and total then counts the remaining matches"),
     user: dict = Depends(get_current_user)
 ):
     """
-    Search and filter users in the organization.
+    Search and filter users in the organization, most recently active first.
     """
     try:
         # Build query with RLS (org_id filtering handled by Supabase RLS)
         query_builder = supabase.table("profiles").select(
-            "id, email, full_name, role, department, position, avatar_url, "
-            "last_active, onboarding_completed"
+            PROFILE_LIST_COLS,
+            count="exact"
         )
         
         # Apply filters
         if query:
-            # Search in full_name, email, and department
-            query_builder = query_builder.or_(
-                f"full_name.ilike.%{query}%,"
-                f"email.ilike.%{query}%,"
-                f"department.ilike.%{query}%"
+            # Full-text search over full_name, email and department (GIN-indexed
+            # search_vector); each word matches as a prefix
+            terms = re.findall(r"\w+", query)
+            if terms:
+                query_builder = query_builder.text_search(
+                    "search_vector",
+                    " & ".join(f"{term}:*" for term in terms),
+                    options={"config": "simple"}
+                )
+        
+        query_builder = _apply_profile_filters(query_builder, role, department, manager_id, include_inactive)
+        
+        # Keyset pagination on (last_active DESC NULLS FIRST, id DESC): a cursor
+        # continues after the last row of the previous page without an offset scan
+        query_builder = query_builder.order(
+            "last_active", desc=True, nullsfirst=True
+        ).order("id", desc=True)
+        
+        if after:
+            last_active, last_id = _decode_cursor(after)
+            if last_active is None:
+                query_builder = query_builder.or_(
+                    f"and(last_active.is.null,id.lt.{last_id}),"
+                    f"last_active.not.is.null"
+                )
+            else:
+                query_builder = query_builder.or_(
+                    f'last_active.lt."{last_active}",'
+                    f'and(last_active.eq."{last_active}",id.lt.{last_id})'
+                )
+            paginated_response = query_builder.limit(limit).execute()
+        else:
+            offset = (page - 1) * limit
+            paginated_response = query_builder.range(offset, offset + limit - 1).execute()
+        
+        # The total comes back with the page
+        total = paginated_response.count or 0
+        rows = paginated_response.data or []
+        next_cursor = _encode_cursor(rows[-1]) if len(rows) == limit else None
+        
+        # No full-text match on the first page: fall back to trigram similarity
+        # on name and email so misspelled queries still find people
+        if query and not rows and not after and page == 1:
+            fuzzy_builder = _apply_profile_filters(
+                supabase.rpc("search_profiles_fuzzy", {"search": query}).select(PROFILE_LIST_COLS),
+                role, department, manager_id, include_inactive
             )
+            rows = fuzzy_builder.limit(limit).execute().data or []
+            total = len(rows)
+            next_cursor = None
         
-        if role:
-            query_builder = query_builder.eq("role", role)
-        
-        if department:
-            query_builder = query_builder.eq("department", department)
-            
-        if manager_id:
-            query_builder = query_builder.eq("manager_id", manager_id)
-        
-        # Handle inactive users (last_active > 30 days ago)
-        if not include_inactive:
-            from datetime import timedelta
-            thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
-            query_builder = query_builder.gte("last_active", thirty_days_ago)
-        
-        # Get total count
-        count_response = query_builder.execute()
-        total = len(count_response.data) if count_response.data else 0
-        
-        # Apply pagination
-        offset = (page - 1) * limit
-        paginated_response = query_builder.range(offset, offset + limit - 1).execute()
-        
-        users = []
-        if paginated_response.data:
-            for user_data in paginated_response.data:
-                users.append(UserListResponse(
-                    id=user_data["id"],
-                    email=user_data["email"],
-                    full_name=user_data["full_name"],
-                    role=user_data["role"],
-                    department=user_data.get("department"),
-                    position=user_data.get("position"),
-                    avatar_url=user_data.get("avatar_url"),
-                    last_active=datetime.fromisoformat(user_data["last_active"]) if user_data.get("last_active") else None,
-                    onboarding_completed=user_data.get("onboarding_completed", False)
-                ))
+        users = USER_LIST_ADAPTER.validate_python(rows)
         
         pages = math.ceil(total / limit) if total > 0 else 1
         
@@ -107,11 +184,14 @@ async def search_users(
             total=total,
             page=page,
             limit=limit,
-            pages=pages
+            pages=pages,
+            next_cursor=next_cursor
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error("User search failed", error=str(e), user_id=user["sub"])
+        logger.error("User search failed", error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to search users"
@@ -141,10 +221,17 @@ async def get_user(
                     detail="Access denied"
                 )
         
-        # Get user profile
-        user_response = supabase.table("profiles").select(
-            "*, manager:manager_id(full_name)"
-        ).eq("id", user_id).single().execute()
+        # Get user profile (with manager name and direct reports embedded via
+        # the manager_id self-reference) and statistics concurrently
+        user_response, stats = await asyncio.gather(
+            asyncio.to_thread(
+                supabase.table("profiles").select(
+                    f"{PROFILE_COLS}, manager:manager_id(full_name), "
+                    f"direct_reports:profiles!manager_id({PROFILE_LIST_COLS})"
+                ).eq("id", user_id).single().execute
+            ),
+            _get_user_stats(user_id)
+        )
         
         if not user_response.data:
             raise HTTPException(
@@ -154,57 +241,18 @@ async def get_user(
         
         user_data = user_response.data
         
-        # Get direct reports if user is a manager
-        direct_reports = []
-        if user_data["role"] in ["manager", "admin"]:
-            reports_response = supabase.table("profiles").select(
-                "id, email, full_name, role, department, position, avatar_url, "
-                "last_active, onboarding_completed"
-            ).eq("manager_id", user_id).execute()
-            
-            if reports_response.data:
-                for report in reports_response.data:
-                    direct_reports.append(UserListResponse(
-                        id=report["id"],
-                        email=report["email"],
-                        full_name=report["full_name"],
-                        role=report["role"],
-                        department=report.get("department"),
-                        position=report.get("position"),
-                        avatar_url=report.get("avatar_url"),
-                        last_active=datetime.fromisoformat(report["last_active"]) if report.get("last_active") else None,
-                        onboarding_completed=report.get("onboarding_completed", False)
-                    ))
-        
-        # Get user statistics
-        stats = await _get_user_stats(user_id)
-        
-        return UserDetailResponse(
-            id=user_data["id"],
-            email=user_data["email"],
-            full_name=user_data["full_name"],
-            role=user_data["role"],
-            org_id=user_data["org_id"],
-            department=user_data.get("department"),
-            position=user_data.get("position"),
-            avatar_url=user_data.get("avatar_url"),
-            manager_id=user_data.get("manager_id"),
-            manager_name=user_data.get("manager", {}).get("full_name") if user_data.get("manager") else None,
-            direct_reports=direct_reports,
-            onboarding_completed=user_data.get("onboarding_completed", False),
-            last_active=datetime.fromisoformat(user_data["last_active"]) if user_data.get("last_active") else None,
-            total_xp=stats["total_xp"],
-            level=stats["level"],
-            badges_count=stats["badges_earned"],
-            courses_completed=stats["courses_completed"],
-            created_at=datetime.fromisoformat(user_data["created_at"]),
-            updated_at=datetime.fromisoformat(user_data["updated_at"]) if user_data.get("updated_at") else None
+        direct_reports = (
+            USER_LIST_ADAPTER.validate_python(user_data.get("direct_reports") or [])
+            if user_data["role"] in ["manager", "admin"] else []
         )
+        manager_name = user_data.get("manager", {}).get("full_name") if user_data.get("manager") else None
+        
+        return _user_detail_response(user_data, manager_name, direct_reports, stats)
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error("Failed to get user", user_id=user_id, error=str(e))
+        logger.error("Failed to get user", target_user_id=user_id, error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to get user information"
@@ -221,42 +269,43 @@ async def update_user(
     Update user information (Manager+ only).
     """
     try:
-        # Check if user exists and is in the same organization
-        existing_user = supabase.table("profiles").select("*").eq("id", user_id).single().execute()
-        
-        if not existing_user.data:
-            raise HTTPException(
-                status_code=404,
-                detail="User not found"
-            )
-        
         # Prepare update data
         update_data = {k: v for k, v in request.dict().items() if v is not None}
         update_data["updated_at"] = datetime.utcnow().isoformat()
         
-        # Update user profile
-        updated_response = supabase.table("profiles").update(update_data).eq("id", user_id).execute()
+        # Update user profile; the updated row comes back, and no row means
+        # the user doesn't exist
+        updated_response = await asyncio.to_thread(
+            supabase.table("profiles").update(update_data).eq("id", user_id).execute
+        )
         
         if not updated_response.data:
             raise HTTPException(
-                status_code=500,
-                detail="Failed to update user"
+                status_code=404,
+                detail="User not found"
             )
         
+        user_data = updated_response.data[0]
+        
         logger.info(
             "User updated",
-            user_id=user_id,
-            updated_by=current_user["sub"],
+            target_user_id=user_id,
             updated_fields=list(update_data.keys())
         )
         
         # Return updated user details
-        return await get_user(user_id, current_user)
+        stats, direct_reports, manager_name = await asyncio.gather(
+            _get_user_stats(user_id),
+            _get_direct_reports(user_data),
+            _get_manager_name(user_data.get("manager_id"))
+        )
+        
+        return _user_detail_response(user_data, manager_name, direct_reports, stats)
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error("Failed to update user", user_id=user_id, error=str(e))
+        logger.error("Failed to update user", target_user_id=user_id, error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to update user"
@@ -272,40 +321,36 @@ async def delete_user(
     Delete user account (Admin only).
     """
     try:
-        # Check if user exists
-        existing_user = supabase.table("profiles").select("*").eq("id", user_id).single().execute()
-        
-        if not existing_user.data:
-            raise HTTPException(
-                status_code=404,
-                detail="User not found"
-            )
-        
-        # Prevent self-deletion
-        if user_id == current_user["sub"]:
-            raise HTTPException(
-                status_code=400,
-                detail="Cannot delete your own account"
+        # Soft delete - mark as deleted instead of hard delete. The self-delete
+        # and existence checks run in the same statement as the update
+        try:
+            await asyncio.to_thread(
+                supabase.rpc(
+                    "soft_delete_user",
+                    {"p_target": user_id, "p_actor": current_user["sub"]}
+                ).execute
             )
+        except APIError as e:
+            if e.message == "cannot_delete_self":
+                raise HTTPException(
+                    status_code=400,
+                    detail="Cannot delete your own account"
+                )
+            if e.message == "not_found":
+                raise HTTPException(
+                    status_code=404,
+                    detail="User not found"
+                )
+            raise
         
-        # Soft delete - mark as inactive instead of hard delete
-        supabase.table("profiles").update({
-            "deleted_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat()
-        }).eq("id", user_id).execute()
-        
-        logger.info(
-            "User deleted",
-            user_id=user_id,
-            deleted_by=current_user["sub"]
-        )
+        logger.info("User deleted", target_user_id=user_id)
         
         return {"message": "User deleted successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error("Failed to delete user", user_id=user_id, error=str(e))
+        logger.error("Failed to delete user", target_user_id=user_id, error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to delete user"
@@ -336,7 +381,7 @@ async def get_user_stats(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error("Failed to get user stats", user_id=user_id, error=str(e))
+        logger.error("Failed to get user stats", target_user_id=user_id, error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to get user statistics"
@@ -353,7 +398,8 @@ async def get_user_activity(
     Get user activity log.
     """
     try:
-        # Check permissions
+        # Check permissions. The shared client doesn't carry the caller's JWT,
+        # so the user_activity_logs RLS policy can't tell callers apart
         if (user_id != current_user["sub"] and 
             current_user["role"] not in ["manager", "admin", "super_admin"]):
             raise HTTPException(
@@ -365,84 +411,110 @@ async def get_user_activity(
             "user_id", user_id
         ).order("created_at", desc=True).limit(limit).execute()
         
-        activities = []
-        if activity_response.data:
-            for activity in activity_response.data:
-                activities.append(UserActivityLog(
-                    id=activity["id"],
-                    user_id=activity["user_id"],
-                    action=activity["action"],
-                    resource_type=activity.get("resource_type"),
-                    resource_id=activity.get("resource_id"),
-                    metadata=activity.get("metadata"),
-                    ip_address=activity.get("ip_address"),
-                    user_agent=activity.get("user_agent"),
-                    created_at=datetime.fromisoformat(activity["created_at"])
-                ))
-        
-        return activities
+        return USER_ACTIVITY_ADAPTER.validate_python(activity_response.data or [])
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error("Failed to get user activity", user_id=user_id, error=str(e))
+        logger.error("Failed to get user activity", target_user_id=user_id, error=str(e))
         raise HTTPException(
             status_code=500,
             detail="Failed to get user activity"
         )
 
 
+def _user_detail_response(
+    user_data: dict,
+    manager_name: Optional[str],
+    direct_reports: List[UserListResponse],
+    stats: dict
+) -> UserDetailResponse:
+    """Build a UserDetailResponse from a profiles row and its related data."""
+    return UserDetailResponse(
+        id=user_data["id"],
+        email=user_data["email"],
+        full_name=user_data["full_name"],
+        role=user_data["role"],
+        org_id=user_data["org_id"],
+        department=user_data.get("department"),
+        position=user_data.get("position"),
+        avatar_url=user_data.get("avatar_url"),
+        manager_id=user_data.get("manager_id"),
+        manager_name=manager_name,
+        direct_reports=direct_reports,
+        onboarding_completed=user_data.get("onboarding_completed", False),
+        last_active=user_data.get("last_active"),
+        total_xp=stats["total_xp"],
+        level=stats["level"],
+        badges_count=stats["badges_earned"],
+        courses_completed=stats["courses_completed"],
+        created_at=user_data["created_at"],
+        updated_at=user_data.get("updated_at")
+    )
+
+
+async def _get_direct_reports(user_data: dict) -> List[UserListResponse]:
+    """Direct reports of a manager or admin; empty for other roles."""
+    if user_data["role"] not in ["manager", "admin"]:
+        return []
+    
+    reports_response = await asyncio.to_thread(
+        supabase.table("profiles").select(
+            PROFILE_LIST_COLS
+        ).eq("manager_id", user_data["id"]).execute
+    )
+    return USER_LIST_ADAPTER.validate_python(reports_response.data or [])
+
+
+async def _get_manager_name(manager_id: Optional[str]) -> Optional[str]:
+    if not manager_id:
+        return None
+    
+    manager_response = await asyncio.to_thread(
+        supabase.table("profiles").select("full_name").eq("id", manager_id).execute
+    )
+    return manager_response.data[0]["full_name"] if manager_response.data else None
+
+
 async def _get_user_stats(user_id: str) -> dict:
     """Helper function to get user statistics."""
+    cache = await get_query_cache()
+    cached = await cache.get("user_stats", (user_id,))
+    if cached is not None:
+        return cached
+    
     try:
-        # Get XP and level
-        xp_response = supabase.table("xp_transactions").select(
-            "xp_earned"
-        ).eq("user_id", user_id).execute()
+        # All counts and sums are computed in one database call, over the
+        # shared asyncpg pool when it's configured
+        db_manager = await get_db_manager()
+        if db_manager.has_pg_pool:
+            rows = await db_manager.execute_query("SELECT * FROM get_user_stats($1::uuid)", user_id)
+        else:
+            stats_response = await asyncio.to_thread(
+                supabase.rpc("get_user_stats", {"p_user": user_id}).execute
+            )
+            rows = stats_response.data
+        row = rows[0] if rows else {}
         
-        total_xp = sum(xp["xp_earned"] for xp in xp_response.data) if xp_response.data else 0
+        total_xp = row.get("total_xp") or 0
         
         # Calculate level (simple formula: every 1000 XP = 1 level)
         level = max(1, total_xp // 1000 + 1)
         level_progress = (total_xp % 1000) / 1000
         
-        # Get badges count
-        badges_response = supabase.table("user_badges").select("id").eq("user_id", user_id).execute()
-        badges_earned = len(badges_response.data) if badges_response.data else 0
-        
-        # Get course completion stats
-        course_completions = supabase.table("course_enrollments").select(
-            "status"
-        ).eq("user_id", user_id).execute()
-        
-        courses_completed = 0
-        courses_in_progress = 0
-        if course_completions.data:
-            for enrollment in course_completions.data:
-                if enrollment["status"] == "completed":
-                    courses_completed += 1
-                elif enrollment["status"] == "in_progress":
-                    courses_in_progress += 1
-        
-        # Get forum stats
-        forum_posts_response = supabase.table("forum_answers").select("id").eq("user_id", user_id).execute()
-        forum_posts = len(forum_posts_response.data) if forum_posts_response.data else 0
-        
-        helpful_answers_response = supabase.table("forum_answers").select("id").eq(
-            "user_id", user_id
-        ).eq("is_helpful", True).execute()
-        forum_helpful_answers = len(helpful_answers_response.data) if helpful_answers_response.data else 0
+        badges_earned = row.get("badges_earned") or 0
+        courses_completed = row.get("courses_completed") or 0
+        courses_in_progress = row.get("courses_in_progress") or 0
+        forum_posts = row.get("forum_posts") or 0
+        forum_helpful_answers = row.get("forum_helpful_answers") or 0
         
         # Calculate login streak (simplified - you might want to implement proper streak logic)
         login_streak = 1  # Placeholder
         
-        # Get last activity
-        user_response = supabase.table("profiles").select("last_active").eq("id", user_id).single().execute()
-        last_activity = None
-        if user_response.data and user_response.data.get("last_active"):
-            last_activity = datetime.fromisoformat(user_response.data["last_active"])
+        # datetime from asyncpg, ISO string from PostgREST; either validates
+        last_activity = row.get("last_active")
         
-        return {
+        stats = {
             "user_id": user_id,
             "total_xp": total_xp,
             "level": level,
@@ -455,9 +527,11 @@ async def _get_user_stats(user_id: str) -> dict:
             "login_streak": login_streak,
             "last_activity": last_activity
         }
+        await cache.set("user_stats", stats, (user_id,), ttl=USER_STATS_TTL, tags={user_stats_tag(user_id)})
+        return stats
         
     except Exception as e:
-        logger.error("Failed to calculate user stats", user_id=user_id, error=str(e))
+        logger.error("Failed to calculate user stats", target_user_id=user_id, error=str(e))
         return {
             "user_id": user_id,
             "total_xp": 0,
@@ -4,6 +4,7 @@
 -- Enable necessary extensions
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 CREATE EXTENSION IF NOT EXISTS "pgcrypto";
+CREATE EXTENSION IF NOT EXISTS "pg_trgm";
 CREATE EXTENSION IF NOT EXISTS "vector" SCHEMA "extensions";
 
 -- Set timezone
@@ -47,7 +48,13 @@ CREATE TABLE profiles (
     last_active TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     deleted_at TIMESTAMP WITH TIME ZONE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    -- Weighted name/email/department vector for user search
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(full_name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(email, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(department, '')), 'C')
+    ) STORED
 );
 
 -- User activity logs
@@ -270,6 +277,7 @@ CREATE TABLE file_uploads (
     original_name VARCHAR(255) NOT NULL,
     mime_type VARCHAR(100) NOT NULL,
     size_bytes BIGINT NOT NULL,
+    content_hash CHAR(64), -- SHA-256 of the file, used to dedupe uploads
     url TEXT NOT NULL,
     uploaded_by UUID NOT NULL REFERENCES profiles(id),
     org_id UUID NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
@@ -348,7 +356,13 @@ CREATE TABLE notifications (
 CREATE INDEX idx_profiles_org_id ON profiles(org_id);
 CREATE INDEX idx_profiles_role ON profiles(role);
 CREATE INDEX idx_profiles_manager_id ON profiles(manager_id);
-CREATE INDEX idx_profiles_last_active ON profiles(last_active);
+CREATE INDEX idx_profiles_search_vector ON profiles USING GIN (search_vector);
+CREATE INDEX idx_profiles_name_trgm ON profiles USING GIN (full_name gin_trgm_ops, email gin_trgm_ops);
+-- Keyset order used by user search; covers its filters and projection so the
+-- default (active users only) path can be an index-only scan
+CREATE INDEX idx_profiles_last_active ON profiles(last_active DESC NULLS FIRST, id DESC)
+    INCLUDE (org_id, role, department, manager_id, email, full_name, position, avatar_url, onboarding_completed)
+    WHERE deleted_at IS NULL;
 
 CREATE INDEX idx_courses_org_id ON courses(org_id);
 CREATE INDEX idx_courses_author_id ON courses(author_id);
@@ -384,12 +398,17 @@ CREATE INDEX idx_forum_answers_user_id ON forum_answers(user_id);
 CREATE INDEX idx_ai_conversations_user_id ON ai_conversations(user_id);
 CREATE INDEX idx_ai_messages_conversation_id ON ai_messages(conversation_id);
 
+CREATE INDEX idx_file_uploads_content_hash ON file_uploads(org_id, content_hash);
+
 CREATE INDEX idx_knowledge_documents_org_id ON knowledge_documents(org_id);
 CREATE INDEX idx_knowledge_documents_source ON knowledge_documents(source_type, source_id);
 
 -- Vector similarity search index
 CREATE INDEX idx_knowledge_documents_embedding ON knowledge_documents USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
 
+-- Full-text search index (used by match_knowledge_documents)
+CREATE INDEX idx_knowledge_documents_content_fts ON knowledge_documents USING GIN (to_tsvector('english', content));
+
 CREATE INDEX idx_notifications_user_id ON notifications(user_id);
 CREATE INDEX idx_notifications_is_read ON notifications(user_id, is_read);
 CREATE INDEX idx_notifications_created_at ON notifications(created_at);
@@ -462,6 +481,18 @@ CREATE POLICY "Managers and admins can update team member profiles" ON profiles
         )
     );
 
+-- User activity logs policies
+CREATE POLICY "Users can view their own activity, managers their organization's" ON user_activity_logs
+    FOR SELECT USING (
+        user_id = auth.uid() OR (
+            user_has_role('manager') AND
+            EXISTS (
+                SELECT 1 FROM profiles p
+                WHERE p.id = user_activity_logs.user_id AND p.org_id = get_user_org_id()
+            )
+        )
+    );
+
 -- Courses policies
 CREATE POLICY "Users can view published courses in their organization" ON courses
     FOR SELECT USING (
@@ -803,6 +834,166 @@ BEGIN
 END;
 $$;
 
+-- Hybrid knowledge search: nearest neighbours (ivfflat) plus full-text matches
+-- (GIN) form a candidate set, which is re-ranked by cosine distance blended
+-- with full-text rank
+CREATE OR REPLACE FUNCTION match_knowledge_documents(
+    org UUID,
+    query_embedding vector(768),
+    query_text TEXT,
+    k int DEFAULT 20,
+    filter_source_type TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    id UUID,
+    title VARCHAR,
+    content TEXT,
+    source_type VARCHAR,
+    source_id UUID,
+    metadata JSONB,
+    created_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE,
+    score float,
+    total_count bigint
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    tsq tsquery := plainto_tsquery('english', query_text);
+BEGIN
+    RETURN QUERY
+    WITH vector_hits AS (
+        SELECT v.id AS doc_id
+        FROM knowledge_documents v
+        WHERE 
+            v.org_id = org
+            AND v.embedding IS NOT NULL
+            AND (filter_source_type IS NULL OR v.source_type = filter_source_type)
+        ORDER BY v.embedding <=> query_embedding
+        LIMIT k * 4
+    ),
+    text_hits AS (
+        SELECT t.id AS doc_id
+        FROM knowledge_documents t
+        WHERE 
+            t.org_id = org
+            AND to_tsvector('english', t.content) @@ tsq
+            AND (filter_source_type IS NULL OR t.source_type = filter_source_type)
+        ORDER BY ts_rank(to_tsvector('english', t.content), tsq) DESC
+        LIMIT k * 4
+    ),
+    candidates AS (
+        SELECT doc_id FROM vector_hits
+        UNION
+        SELECT doc_id FROM text_hits
+    ),
+    -- Every document the search can rank: embedded, or matching the text
+    eligible AS (
+        SELECT COUNT(*) AS n
+        FROM knowledge_documents e
+        WHERE 
+            e.org_id = org
+            AND (filter_source_type IS NULL OR e.source_type = filter_source_type)
+            AND (e.embedding IS NOT NULL OR to_tsvector('english', e.content) @@ tsq)
+    )
+    SELECT 
+        kd.id,
+        kd.title,
+        kd.content,
+        kd.source_type,
+        kd.source_id,
+        kd.metadata,
+        kd.created_at,
+        kd.updated_at,
+        -- Documents stored without an embedding rank as orthogonal
+        (0.5 * COALESCE(kd.embedding <=> query_embedding, 1)
+            + 0.5 * (1 - ts_rank(to_tsvector('english', kd.content), tsq)))::float AS score,
+        eligible.n AS total_count
+    FROM candidates c
+    JOIN knowledge_documents kd ON kd.id = c.doc_id
+    CROSS JOIN eligible
+    ORDER BY score
+    LIMIT k;
+END;
+$$;
+
+-- Typo-tolerant profile search, used when full-text search finds nothing
+CREATE OR REPLACE FUNCTION search_profiles_fuzzy(search TEXT)
+RETURNS SETOF profiles
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT *
+    FROM profiles
+    WHERE full_name % search OR email % search
+    ORDER BY GREATEST(similarity(full_name, search), similarity(email, search)) DESC;
+$$;
+
+-- Per-user statistics in a single round-trip (used by the users API)
+CREATE OR REPLACE FUNCTION get_user_stats(p_user UUID)
+RETURNS TABLE (
+    total_xp BIGINT,
+    badges_earned BIGINT,
+    courses_completed BIGINT,
+    courses_in_progress BIGINT,
+    forum_posts BIGINT,
+    forum_helpful_answers BIGINT,
+    last_active TIMESTAMP WITH TIME ZONE
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT
+        (SELECT COALESCE(SUM(xp_earned), 0) FROM xp_transactions WHERE user_id = p_user),
+        (SELECT COUNT(*) FROM user_badges WHERE user_id = p_user),
+        (SELECT COUNT(*) FROM course_enrollments WHERE user_id = p_user AND status = 'completed'),
+        (SELECT COUNT(*) FROM course_enrollments WHERE user_id = p_user AND status = 'in_progress'),
+        (SELECT COUNT(*) FROM forum_answers WHERE user_id = p_user),
+        (SELECT COUNT(*) FROM forum_answers WHERE user_id = p_user AND is_helpful),
+        (SELECT p.last_active FROM profiles p WHERE p.id = p_user);
+$$;
+
+-- Update a knowledge document and merge its metadata in one statement
+CREATE OR REPLACE FUNCTION update_knowledge_document_merge(
+    doc_id UUID,
+    org UUID,
+    new_title TEXT,
+    new_content TEXT,
+    metadata_patch JSONB
+)
+RETURNS SETOF knowledge_documents
+LANGUAGE sql
+AS $$
+    UPDATE knowledge_documents
+    SET 
+        title = new_title,
+        content = new_content,
+        metadata = COALESCE(metadata, '{}'::jsonb) || metadata_patch,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = doc_id AND org_id = org
+    RETURNING *;
+$$;
+
+-- Soft-delete a user in one statement; raises cannot_delete_self / not_found
+CREATE OR REPLACE FUNCTION soft_delete_user(p_target UUID, p_actor UUID)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF p_target = p_actor THEN
+        RAISE EXCEPTION 'cannot_delete_self';
+    END IF;
+
+    UPDATE profiles
+    SET deleted_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_target AND deleted_at IS NULL;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'not_found';
+    END IF;
+END;
+$$;
+
 -- Grant permissions to authenticated users
 GRANT USAGE ON SCHEMA public TO authenticated;
 GRANT ALL ON ALL TABLES IN SCHEMA public TO authenticated;